@@ -0,0 +1,560 @@
+"""Benchmarks for the MultiMap classes, against dict, OrderedDict and a plain
+list of pairs.
+
+Every operation is run for every class over a matrix of sizes and key
+distributions, and the results are written out as JSON so that runs can be
+diffed. Each measurement runs for (at least) one pass and then keeps going
+until its time budget is spent. The whole matrix up to a million pairs takes
+a long while (the list baseline especially); use --sizes, --dists, --subjects
+and --ops to narrow a run down.
+
+    python benchmark.py --sizes 10,1000 --ops lookup,insert -o before.json
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from operator import itemgetter
+from timeit import default_timer as timer
+
+from multimap import (MultiMap, MutableMultiMap, LinkedMutableMultiMap,
+    CompactMultiMap, FrozenMultiMap, MappedMultiMap, DelayedMultiMap,
+    DelayedMutableMultiMap, ConcurrentMultiMap)
+
+
+# How many keys are probed by the operations which act on single keys.
+PROBES = 100
+
+
+def _unique(n, rand):
+    return range(n)
+
+def _dup10(n, rand):
+    return [rand.randrange(max(1, n // 10)) for i in xrange(n)]
+
+def _skewed(n, rand):
+    # Log-uniform, so a handful of keys have most of the pairs.
+    return [int(n ** rand.random()) for i in xrange(n)]
+
+def _single(n, rand):
+    return [0] * n
+
+DISTRIBUTIONS = OrderedDict([
+    ('unique', _unique),
+    ('dup10', _dup10),
+    ('skewed', _skewed),
+    ('single', _single),
+])
+
+
+class Subject(object):
+
+    """Adapts one mapping type to the benchmarked operations.
+
+    Methods which are None are not supported by the subject, and those
+    benchmarks are skipped for it.
+
+    """
+
+    def __init__(self, name, cls, mutable=True):
+        self.name = name
+        self.cls = cls
+        if not mutable:
+            self.insert = self.delete = self.popone = self.setall = None
+            self.sort = self.sort_keys = self.reverse = None
+        if not hasattr(cls, 'copy'):
+            self.copy = None
+
+    def build(self, pairs):
+        return self.cls(pairs)
+
+    def close(self, m):
+        pass
+
+    def lookup(self, m, key):
+        return m[key]
+
+    def getall(self, m, key):
+        return m.getall(key)
+
+    def keysfor(self, m, value):
+        return m.keysfor(value)
+
+    def iterate(self, m):
+        for pair in m.iteritems():
+            pass
+
+    def iterall(self, m):
+        for pair in m.iterallitems():
+            pass
+
+    def insert(self, m, index, key, value):
+        m.insert(index, (key, value))
+
+    def delete(self, m, key):
+        del m[key]
+
+    def popone(self, m, key):
+        return m.popone(key)
+
+    def setall(self, m, key, values):
+        m.setall(key, values)
+
+    def sort(self, m):
+        m.sort()
+
+    def sort_keys(self, m):
+        m.sort_keys()
+
+    def reverse(self, m):
+        m.reverse()
+
+    def copy(self, m):
+        return m.copy()
+
+
+class ValueIndexedSubject(Subject):
+
+    def build(self, pairs):
+        m = self.cls(pairs)
+        m.index_values()
+        return m
+
+
+class DelayedSubject(Subject):
+
+    def build(self, pairs):
+        return self.cls(lambda: iter(pairs))
+
+
+class MappedSubject(Subject):
+
+    def __init__(self, name, cls):
+        super(MappedSubject, self).__init__(name, cls, mutable=False)
+
+    def build(self, pairs):
+        fd, path = tempfile.mkstemp(suffix='.mmf')
+        os.close(fd)
+        self.cls.write(path, pairs)
+        return self.cls(path)
+
+    def close(self, m):
+        m.close()
+        os.unlink(m.path)
+
+
+class DictSubject(Subject):
+
+    """dict and OrderedDict; later values for a key replace earlier ones."""
+
+    def __init__(self, name, cls):
+        super(DictSubject, self).__init__(name, cls)
+        self.getall = self.popone = self.insert = None
+        self.sort = self.sort_keys = self.reverse = None
+        self.iterate = self.iterall
+
+    def iterall(self, m):
+        for pair in m.iteritems():
+            pass
+
+    def keysfor(self, m, value):
+        return [k for k, v in m.iteritems() if v == value]
+
+    def setall(self, m, key, values):
+        m[key] = values[-1]
+
+    def copy(self, m):
+        return m.copy()
+
+
+class ListSubject(Subject):
+
+    """The naive approach: a list of pairs, scanned for every key."""
+
+    def __init__(self):
+        super(ListSubject, self).__init__('list', list)
+        self.setall = self.iterate = None
+
+    def lookup(self, m, key):
+        for k, v in m:
+            if k == key:
+                return v
+        raise KeyError(key)
+
+    def getall(self, m, key):
+        return [v for k, v in m if k == key]
+
+    def keysfor(self, m, value):
+        keys = []
+        for k, v in m:
+            if v == value and k not in keys:
+                keys.append(k)
+        return keys
+
+    def iterall(self, m):
+        for pair in m:
+            pass
+
+    def insert(self, m, index, key, value):
+        m.insert(index, (key, value))
+
+    def delete(self, m, key):
+        m[:] = [pair for pair in m if pair[0] != key]
+
+    def popone(self, m, key):
+        for i, pair in enumerate(m):
+            if pair[0] == key:
+                return m.pop(i)[1]
+        raise KeyError(key)
+
+    def sort_keys(self, m):
+        m.sort(key=itemgetter(0))
+
+    def copy(self, m):
+        return list(m)
+
+
+SUBJECTS = OrderedDict((s.name, s) for s in [
+    Subject('MultiMap', MultiMap, mutable=False),
+    Subject('MutableMultiMap', MutableMultiMap),
+    ValueIndexedSubject('MutableMultiMap+values', MutableMultiMap),
+    Subject('LinkedMutableMultiMap', LinkedMutableMultiMap),
+    Subject('CompactMultiMap', CompactMultiMap, mutable=False),
+    Subject('FrozenMultiMap', FrozenMultiMap, mutable=False),
+    MappedSubject('MappedMultiMap', MappedMultiMap),
+    DelayedSubject('DelayedMultiMap', DelayedMultiMap, mutable=False),
+    DelayedSubject('DelayedMutableMultiMap', DelayedMutableMultiMap),
+    Subject('ConcurrentMultiMap', ConcurrentMultiMap),
+    DictSubject('dict', dict),
+    DictSubject('OrderedDict', OrderedDict),
+    ListSubject(),
+])
+
+
+# Each benchmark is a function of (subject, data) which returns a pair of
+# (setup, run) callables, or None if the subject does not support it. setup()
+# is called outside of the timer before every run, and run(state) returns the
+# number of operations it performed.
+
+def _reads(method, arg):
+    def bench(subject, data):
+        func = getattr(subject, method)
+        if func is None:
+            return None
+        def run(m):
+            for x in data[arg]:
+                func(m, x)
+            return len(data[arg])
+        return data['shared'], run
+    return bench
+
+def _whole(method):
+    def bench(subject, data):
+        func = getattr(subject, method)
+        if func is None:
+            return None
+        def run(m):
+            func(m)
+            return 1
+        return data['shared'], run
+    return bench
+
+def _writes(method, make_args, count=PROBES):
+    def bench(subject, data):
+        func = getattr(subject, method)
+        if func is None:
+            return None
+        args = make_args(data)[:count]
+        def run(m):
+            for a in args:
+                try:
+                    func(m, *a)
+                except KeyError:
+                    pass
+            subject.close(m)
+            return len(args)
+        return data['fresh'], run
+    return bench
+
+def _construct(subject, data):
+    def run(pairs):
+        subject.close(subject.build(pairs))
+        return 1
+    return (lambda: data['pairs']), run
+
+def _first_lookup(subject, data):
+    # Time to the first answer; this is where the delayed maps differ.
+    key = data['pairs'][0][0]
+    def run(pairs):
+        m = subject.build(pairs)
+        subject.lookup(m, key)
+        subject.close(m)
+        return 1
+    return (lambda: data['pairs']), run
+
+def _copy(subject, data):
+    if subject.copy is None:
+        return None
+    def run(m):
+        subject.copy(m)
+        return 1
+    return data['shared'], run
+
+def _inserts(data):
+    n = len(data['pairs'])
+    return [(n // 2, key, 'inserted') for key in data['present']]
+
+BENCHMARKS = OrderedDict([
+    ('construct', _construct),
+    ('first_lookup', _first_lookup),
+    ('lookup', _reads('lookup', 'present')),
+    ('getall', _reads('getall', 'present')),
+    ('keysfor', _reads('keysfor', 'values')),
+    ('iterate', _whole('iterate')),
+    ('iterall', _whole('iterall')),
+    ('copy', _copy),
+    ('insert', _writes('insert', _inserts)),
+    ('delete', _writes('delete', lambda d: [(k, ) for k in d['present']])),
+    ('popone', _writes('popone', lambda d: [(k, ) for k in d['present']])),
+    ('setall', _writes('setall',
+        lambda d: [(k, ['a', 'b']) for k in d['present']])),
+    ('sort', _writes('sort', lambda d: [()], 1)),
+    ('sort_keys', _writes('sort_keys', lambda d: [()], 1)),
+    ('reverse', _writes('reverse', lambda d: [()], 1)),
+])
+
+
+def measure(setup, run, budget):
+    # The budget includes the (untimed) setup, since rebuilding a big map for
+    # every run can easily cost more than the run itself.
+    runs = ops = 0
+    seconds = 0.0
+    deadline = timer() + budget
+    while not runs or timer() < deadline:
+        state = setup()
+        start = timer()
+        ops += run(state)
+        seconds += timer() - start
+        runs += 1
+    return dict(runs=runs, ops=ops, seconds=seconds,
+        per_op=seconds / ops if ops else None)
+
+
+def make_data(subject, size, dist, seed):
+    rand = random.Random(seed)
+    keys = DISTRIBUTIONS[dist](size, rand)
+    pairs = [(key, i) for i, key in enumerate(keys)]
+    distinct = sorted(set(keys))
+    present = [rand.choice(distinct) for i in xrange(PROBES)] if distinct else []
+    values = [rand.choice(pairs)[1] for i in xrange(PROBES)] if pairs else []
+    cache = {}
+    def shared():
+        # Read-only benchmarks share one map per subject.
+        if 'map' not in cache:
+            cache['map'] = subject.build(pairs)
+        return cache['map']
+    def fresh():
+        return subject.build(pairs)
+    return dict(pairs=pairs, keys=len(distinct), present=present,
+        values=values, shared=shared, fresh=fresh, cache=cache)
+
+
+def _index_bytes(index):
+    # A dict of lists of positions; small ints are shared, so aren't counted.
+    size = sys.getsizeof(index)
+    for ids in index.itervalues():
+        size += sys.getsizeof(ids)
+        size += sum(sys.getsizeof(i) for i in ids if i > 256)
+    return size
+
+
+def index_memory(size, dist, seed):
+    """Roughly how many bytes the key index and the value index take, with
+    the keys and the values both drawn from the given distribution.
+
+    """
+    rand = random.Random(seed)
+    keys = DISTRIBUTIONS[dist](size, rand)
+    values = DISTRIBUTIONS[dist](size, rand)
+    rand.shuffle(values)
+    m = MutableMultiMap(zip(keys, values))
+    m.index_values()
+    return dict(key_index_bytes=_index_bytes(m._key_ids),
+        value_index_bytes=_index_bytes(m._value_ids),
+        pairs_bytes=sys.getsizeof(m._pairs) + sum(sys.getsizeof(pair)
+            for pair in m._pairs))
+
+
+class LockedMultiMap(object):
+
+    """The alternative to a ConcurrentMultiMap: one lock around every call."""
+
+    def __init__(self, pairs):
+        self._lock = threading.Lock()
+        self._map = MutableMultiMap(pairs)
+
+    def getall(self, key):
+        with self._lock:
+            return self._map.getall(key)
+
+    def setall(self, key, values):
+        with self._lock:
+            self._map.setall(key, values)
+
+
+def contention(cls, size, readers, writers, seconds, seed, write_delay=0):
+    """Count reads and writes per second with the given number of threads
+    all hammering on one map.
+
+    The writers sleep for write_delay seconds between every PROBES writes,
+    to model maps which are read far more often than they are written.
+
+    """
+    rand = random.Random(seed)
+    keys = _dup10(size, rand)
+    m = cls([(key, i) for i, key in enumerate(keys)])
+    probes = [rand.choice(keys) for i in xrange(PROBES)]
+    counts = []
+    stop = []
+
+    def read():
+        n = 0
+        while not stop:
+            for key in probes:
+                m.getall(key)
+            n += len(probes)
+        counts.append(('reads', n))
+
+    def write():
+        n = 0
+        while not stop:
+            for key in probes:
+                m.setall(key, [n, n])
+            n += len(probes)
+            if write_delay:
+                time.sleep(write_delay)
+        counts.append(('writes', n))
+
+    threads = [threading.Thread(target=read) for i in xrange(readers)]
+    threads.extend(threading.Thread(target=write) for i in xrange(writers))
+    start = timer()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.append(True)
+    for thread in threads:
+        thread.join()
+    elapsed = timer() - start
+    totals = dict(reads=0, writes=0)
+    for kind, n in counts:
+        totals[kind] += n
+    return dict(reads_per_second=totals['reads'] / elapsed,
+        writes_per_second=totals['writes'] / elapsed)
+
+
+CONTENDERS = OrderedDict([
+    ('ConcurrentMultiMap', ConcurrentMultiMap),
+    ('LockedMultiMap', LockedMultiMap),
+])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000,1000000',
+        help='comma separated pair counts (default: %(default)s)')
+    parser.add_argument('--dists', default=','.join(DISTRIBUTIONS),
+        help='comma separated key distributions (default: %(default)s)')
+    parser.add_argument('--subjects', default=','.join(SUBJECTS),
+        help='comma separated classes (default: all)')
+    parser.add_argument('--ops', default=','.join(BENCHMARKS),
+        help='comma separated operations (default: all)')
+    parser.add_argument('--budget', type=float, default=0.2,
+        help='seconds to spend per measurement (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--contention', metavar='READERS',
+        help='instead, run the threaded benchmark with these comma separated '
+        'numbers of reader threads (for --budget seconds each)')
+    parser.add_argument('--writers', type=int, default=1,
+        help='writer threads for --contention (default: %(default)s)')
+    parser.add_argument('--write-delay', type=float, default=0,
+        help='seconds for --contention writers to sleep between batches of '
+        'writes (default: %(default)s)')
+    parser.add_argument('--memory', action='store_true',
+        help='instead, measure the memory taken by the key and value indexes')
+    parser.add_argument('-o', '--output', help='write JSON here (default: stdout)')
+    args = parser.parse_args(argv)
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    dists = args.dists.split(',')
+    subjects = [SUBJECTS[x] for x in args.subjects.split(',')]
+    ops = args.ops.split(',')
+
+    results = []
+    for size in sizes if args.contention else ():
+        for readers in [int(x) for x in args.contention.split(',')]:
+            for name, cls in CONTENDERS.iteritems():
+                result = contention(cls, size, readers, args.writers,
+                    args.budget, args.seed, args.write_delay)
+                result.update(subject=name, op='contention', size=size,
+                    dist='dup10', readers=readers, writers=args.writers,
+                    write_delay=args.write_delay)
+                results.append(result)
+                print >> sys.stderr, '%-22s %8d %3d readers %12.0f reads/s %10.0f writes/s' % (
+                    name, size, readers, result['reads_per_second'],
+                    result['writes_per_second'])
+    for size in sizes if args.memory else ():
+        for dist in dists:
+            result = index_memory(size, dist, args.seed)
+            result.update(op='memory', size=size, dist=dist)
+            results.append(result)
+            print >> sys.stderr, '%8d %-7s %8.1f bytes/pair of pairs %8.1f of key index %8.1f of value index' % (
+                size, dist, result['pairs_bytes'] / float(size or 1),
+                result['key_index_bytes'] / float(size or 1),
+                result['value_index_bytes'] / float(size or 1))
+    for size in sizes if not (args.contention or args.memory) else ():
+        for dist in dists:
+            for subject in subjects:
+                data = make_data(subject, size, dist, args.seed)
+                for op in ops:
+                    bench = BENCHMARKS[op](subject, data)
+                    if bench is None:
+                        continue
+                    result = measure(bench[0], bench[1], args.budget)
+                    result.update(subject=subject.name, op=op, size=size,
+                        dist=dist, keys=data['keys'])
+                    results.append(result)
+                    print >> sys.stderr, '%-22s %-12s %8d %-7s %12.3fus' % (
+                        subject.name, op, size, dist,
+                        1e6 * (result['per_op'] or 0))
+                if 'map' in data['cache']:
+                    subject.close(data['cache']['map'])
+
+    out = dict(
+        meta=dict(
+            python=sys.version,
+            platform=platform.platform(),
+            time=time.time(),
+            argv=sys.argv[1:] if argv is None else argv,
+            budget=args.budget,
+            seed=args.seed,
+        ),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(out, fh, indent=1, sort_keys=True)
+    else:
+        json.dump(out, sys.stdout, indent=1, sort_keys=True)
+        print
+
+
+if __name__ == '__main__':
+    main()
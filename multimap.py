@@ -19,23 +19,391 @@ with no word seperators.
 
 Internally the mapping is represented as a list of (key, value) pairs (which
 is what maintains the order) AND a mapping of keys to a list of positions in
-the pair list (for making everything faster). Need to keep in mind that any
-given list in _key_ids may be empty.
+the pair list (for making everything faster). A key is removed from _key_ids
+along with its last pair, so none of the lists in it are ever empty. Lookups
+must not add keys to it either, otherwise every missed lookup would grow it.
 
-I have not implemented something corresponding to the following list methods:
-    - count
-    - index
-    - remove
+The mutable versions do not shift the pair list on every removal. Removed
+pairs are replaced with None in place (a "tombstone") so none of the positions
+in _key_ids need to change, and _dead counts them. Once enough of the list is
+dead it is compacted in a single pass. Anything which walks _pairs directly
+must skip the None entries.
+
+LinkedMutableMultiMap keeps its pairs as nodes in a list of blocks instead,
+with the key index holding the nodes, so that inserting in the middle of the
+order does not renumber anything. It builds _pairs and _key_ids on demand.
+
+The list methods count, index and remove are a little different: count
+takes a key (and counts its values), while index and remove take a pair. The
+pairs property is a live sequence view of all the pairs, which supports the
+usual sequence methods on pairs.
 
 """
 
 
 import collections
-from bisect import bisect
+import contextlib
+import difflib
+import functools
+import marshal
+import mmap
+import struct
+import threading
+import types
+import cPickle as pickle
+from bisect import bisect_left, bisect_right, insort
+from operator import itemgetter
+from itertools import islice, izip
+from array import array
+from timeit import default_timer as _timer
+from zlib import crc32
+
+
+# The header of MultiMap.to_bytes: magic, size of the array items, the
+# number of keys, the number of pairs, and the size of the pickled key table.
+_BYTES_MAGIC = 'MMB1'
+_BYTES_HEADER = struct.Struct('=4sBQQQ')
+
+
+def _restore(cls, flat):
+    """Rebuild a MultiMap from the flat form given by its __reduce__.
+    
+    As with any other pickle, __init__ is not called; _set_flat sets up the
+    storage.
+    
+    """
+    keys, itemsize, offsets, positions, values = flat
+    self = cls.__new__(cls)
+    self._set_flat(keys, _load_ids(itemsize, offsets),
+        _load_ids(itemsize, positions), values)
+    return self
+
+
+def _load_ids(itemsize, data):
+    ids = array('l')
+    if ids.itemsize != itemsize:
+        raise ValueError('positions were stored with %d byte integers; '
+            'we use %d' % (itemsize, ids.itemsize))
+    ids.fromstring(data)
+    return ids
+
+
+def _iter_args(args, kwargs):
+    """Iterate across the raw pairs given to a MultiMap constructor."""
+    for arg in args:
+        if isinstance(arg, collections.Mapping):
+            for x in arg.items():
+                yield x
+        else:
+            for x in arg:
+                yield x
+    for x in kwargs.items():
+        yield x
+
+
+def _common_prefix(a, b):
+    """The length of the common prefix of two lists.
+    
+    Slices are compared instead of single items, halving the step after
+    every miss, so it is only O(log n) steps in Python and the rest in C.
+    
+    """
+    lo = 0
+    hi = min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _conforming_class(cls, base, prefix):
+    """Get a subclass of base which conforms keys and values as cls does.
+    
+    This is base itself if cls does not override any of the conform methods.
+    Otherwise the subclass is made once, named by prefixing the name of cls,
+    and remembers cls as its _frozen_class or _thawed_class to go back to.
+    
+    Everything the classes between cls and this module's own classes define
+    is copied into it, so that conform methods can use their helpers and
+    class attributes, except for __init__ and the methods which only one of
+    MutableMultiMap and FrozenMultiMap have (the mutators, hash and thaw).
+    Methods which use super() with their own class can't be copied this way;
+    such classes need _frozen_class (or _thawed_class) set explicitly.
+    
+    """
+    cls = getattr(cls, '_instrumented_base', cls)
+    if cls._conforms_nothing():
+        return base
+    derived = cls.__dict__.get('_conforming_classes')
+    if derived is None:
+        derived = {}
+        setattr(cls, '_conforming_classes', derived)
+    try:
+        return derived[base]
+    except KeyError:
+        pass
+    
+    skip = _library_names()
+    namespace = {}
+    for klass in reversed(cls.__mro__):
+        if klass in _LIBRARY_CLASSES or klass is object:
+            continue
+        for name, value in klass.__dict__.iteritems():
+            if name not in skip and not isinstance(value,
+                types.MemberDescriptorType):
+                namespace[name] = value
+    namespace.update(
+        __module__=cls.__module__,
+        __doc__=cls.__doc__,
+    )
+    if issubclass(base, FrozenMultiMap):
+        namespace['_thawed_class'] = cls
+    else:
+        namespace['_frozen_class'] = cls
+    derived[base] = type(prefix + cls.__name__, (base, ), namespace)
+    return derived[base]
+
+
+def _library_names():
+    """The names _conforming_class does not copy."""
+    return (set(dir(MutableMultiMap)) ^ set(dir(FrozenMultiMap))) | set([
+        '__init__', '__new__', '__dict__', '__weakref__', '__slots__',
+        '_conforming_classes', '_frozen_class', '_thawed_class'])
+
+
+def _sorted_key_groups(keys, key=None, reverse=False):
+    """Sort the unique keys of a map for sort_keys.
+    
+    The keys are given in the order of their first pairs, and come back in
+    lists of those which sort equal (by the key function), in that same
+    order. The pairs of a list must be merged in their current order to keep
+    the sort stable.
+    
+    """
+    if key is None:
+        return [[k] for k in sorted(keys, reverse=reverse)]
+    sort_keys = map(key, keys)
+    groups = []
+    last = None
+    for i in sorted(xrange(len(keys)), key=sort_keys.__getitem__,
+        reverse=reverse):
+        if groups and sort_keys[i] == last:
+            groups[-1].append(keys[i])
+        else:
+            groups.append([keys[i]])
+            last = sort_keys[i]
+    return groups
+
+
+class KeyCache(object):
+    """A size-capped memo used by conform_cache.
+    
+    Once maxsize entries are stored it is emptied and starts over, which is
+    cheaper to maintain than an LRU and works well for the small, repetitive
+    sets of keys (header names, query parameters) it is meant for.
+    
+    """
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __repr__(self):
+        return '<%s hits=%d misses=%d size=%d/%d>' % (self.__class__.__name__,
+            self.hits, self.misses, len(self.data), self.maxsize)
+    
+    def clear(self):
+        self.data.clear()
+        self.hits = self.misses = 0
+
+
+def conform_cache(maxsize=1024, pure=False):
+    """Decorate a _conform_key (or _conform_value) method to memoize it.
+    
+    By default every instance gets its own cache. If the method is pure (its
+    result depends only on the key, not on the instance) pass pure=True to
+    share one cache between all instances. Unhashable keys are passed
+    straight through to the method, and keys which compare equal share an
+    entry.
+    
+    The decorated method has a cache_of(instance) function which returns the
+    KeyCache used for that instance (None if it has not been used yet), and
+    pure caches are also available as its cache attribute.
+    
+    >>> class CaseInsensitive(MutableMultiMap):
+    ...     @conform_cache(pure=True)
+    ...     def _conform_key(self, key):
+    ...         return key.lower()
+    >>> m = CaseInsensitive()
+    >>> m['Content-Type'] = 'text/plain'
+    >>> m['CONTENT-TYPE'], m.get('content-type')
+    ('text/plain', 'text/plain')
+    >>> CaseInsensitive._conform_key.cache
+    <KeyCache hits=0 misses=3 size=3/1024>
+    >>> m['Content-Type']
+    'text/plain'
+    >>> CaseInsensitive._conform_key.cache_of(m).hits
+    1
+    
+    """
+    def decorator(func):
+        shared = KeyCache(maxsize) if pure else None
+        name = '_%s_cache' % func.__name__.strip('_')
+        
+        @functools.wraps(func)
+        def cached(self, key):
+            cache = shared
+            if cache is None:
+                cache = self.__dict__.get(name)
+                if cache is None:
+                    cache = self.__dict__[name] = KeyCache(maxsize)
+            data = cache.data
+            try:
+                value = data[key]
+            except KeyError:
+                pass
+            except TypeError:
+                return func(self, key)
+            else:
+                cache.hits += 1
+                return value
+            cache.misses += 1
+            value = func(self, key)
+            if len(data) >= cache.maxsize:
+                data.clear()
+            data[key] = value
+            return value
+        
+        def cache_of(instance):
+            if shared is not None:
+                return shared
+            return instance.__dict__.get(name)
+        
+        cached.cache = shared
+        cached.cache_of = cache_of
+        return cached
+    
+    return decorator
+
+
+class PairsView(collections.Sequence):
+    """A live sequence of all the pairs of a map, in order.
+    
+    Nothing is copied to build it, and it always reflects the current state
+    of the map. Indexing goes straight to the map's storage, slicing returns
+    a new map of the slice, and index/count/remove only look at the pairs
+    with the same key.
+    
+    >>> m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3), ('c', 4)])
+    >>> pairs = m.pairs
+    >>> len(pairs), pairs[0], pairs[-1]
+    (4, ('a', 1), ('c', 4))
+    >>> pairs[1:3]
+    MutableMultiMap([('b', 2), ('a', 3)])
+    >>> pairs.index(('a', 3)), pairs.count(('a', 3)), ('a', 2) in pairs
+    (2, 1, False)
+    >>> pairs.remove(('a', 1))
+    >>> m
+    MutableMultiMap([('b', 2), ('a', 3), ('c', 4)])
+    >>> pairs[0]
+    ('b', 2)
+    
+    """
+    
+    __slots__ = ('_map', )
+    
+    def __init__(self, map):
+        self._map = map
+    
+    def __repr__(self):
+        return '<%s of %r>' % (self.__class__.__name__, self._map)
+    
+    def __len__(self):
+        return self._map.alllen()
+    
+    def __getitem__(self, index):
+        map = self._map
+        if isinstance(index, slice):
+            cls = map._slice_class or map.__class__
+            return cls.from_pairs(map._pair_slice(index), trusted=True)
+        return map._pair_at(map._stored_index(index))
+    
+    def __iter__(self):
+        return self._map.iterallitems()
+    
+    def __reversed__(self):
+        return reversed(self._map.allitems())
+    
+    def __contains__(self, pair):
+        try:
+            self._map.index(pair)
+        except ValueError:
+            return False
+        return True
+    
+    def index(self, pair, start=0, stop=None):
+        return self._map.index(pair, start, stop)
+    
+    def count(self, pair):
+        map = self._map
+        key, value = map._conform_pair(pair)
+        return sum(1 for i in map._positions_of(key)
+            if map._pair_at(i)[1] == value)
+    
+    def remove(self, pair):
+        self._map.remove(pair)
+
+
+class GroupedView(collections.Mapping):
+    """A read-only snapshot of a map grouped by key.
+    
+    Maps each key to a tuple of all of its values, with the keys in order of
+    their first pair. Keys are conformed by the map it came from. See
+    MultiMap.grouped.
+    
+    """
+    
+    __slots__ = ('_keys', '_values', '_conform_key')
+    
+    def __init__(self, itemlists, conform_key):
+        self._keys = keys = []
+        self._values = values = {}
+        for key, key_values in itemlists:
+            keys.append(key)
+            values[key] = tuple(key_values)
+        self._conform_key = conform_key
+    
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__,
+            [(key, self._values[key]) for key in self._keys])
+    
+    def __getitem__(self, key):
+        return self._values[self._conform_key(key)]
+    
+    def __contains__(self, key):
+        return self._conform_key(key) in self._values
+    
+    def __iter__(self):
+        return iter(self._keys)
+    
+    def __len__(self):
+        return len(self._keys)
+
 
 class MultiMap(collections.Mapping):
     """An ordered mapping which supports multiple values for the same key."""
     
+    # The number of tombstones in _pairs. Only the mutable versions leave any.
+    _dead = 0
+    
     def __init__(self, *args, **kwargs):
         """Initialize a MultiMap.
         
@@ -56,23 +424,21 @@ class MultiMap(collections.Mapping):
         MultiMap([('a', 1), ('b', 2), ('c', 3), ('c', 4)])
         
         """
-        self._pairs = []
-        for arg in args:
-            if isinstance(arg, collections.Mapping):
-                for x in arg.items():
-                    self._pairs.append(self._conform_pair(x))
-            else:
-                for x in arg:
-                    self._pairs.append(self._conform_pair(x))
-        for x in kwargs.items():
-            self._pairs.append(self._conform_pair(x))
+        self._set_pairs(self._conform_pairs(_iter_args(args, kwargs)))
+    
+    def _set_pairs(self, pairs):
+        """Take the given list of conformed pairs as our contents."""
+        self._pairs = pairs
         self._rebuild_key_ids()
     
     def _rebuild_key_ids(self):
         """Rebuild the internal key to index mapping."""
-        self._key_ids = collections.defaultdict(list)
+        self._key_ids = key_ids = {}
         for i, x in enumerate(self._pairs):
-            self._key_ids[x[0]].append(i)
+            try:
+                key_ids[x[0]].append(i)
+            except KeyError:
+                key_ids[x[0]] = [i]
     
     def _conform_key(self, key):
         """Force a given key into certain form.
@@ -102,12 +468,60 @@ class MultiMap(collections.Mapping):
             raise ValueError('MultiMap element must have length 2')
         return (self._conform_key(pair[0]), self._conform_value(pair[1]))
     
+    @classmethod
+    def _conforms_nothing(cls):
+        """Are all of the conform methods the default (do-nothing) ones?"""
+        return (
+            cls._conform_pair.im_func is MultiMap._conform_pair.im_func and
+            cls._conform_key.im_func is MultiMap._conform_key.im_func and
+            cls._conform_value.im_func is MultiMap._conform_value.im_func
+        )
+    
+    def _conform_pairs(self, pairs):
+        """Conform an iterable of pairs into a new list."""
+        if not self._conforms_nothing():
+            conform = self._conform_pair
+            return [conform(x) for x in pairs]
+        
+        # All that is left to do is to check the shape, which we can do
+        # without a Python-level call per pair.
+        pairs = map(tuple, pairs)
+        if pairs and set(map(len, pairs)) != set([2]):
+            raise ValueError('MultiMap element must have length 2')
+        return pairs
+    
+    @classmethod
+    def from_pairs(cls, pairs, trusted=False):
+        """Build a mapping from an iterable of (key, value) pairs.
+        
+        This is the fastest way to build a mapping. If trusted is true the
+        pairs must already be 2-tuples; unless the class overrides one of the
+        conform methods they are then used as they are.
+        
+        >>> MultiMap.from_pairs([('a', 1), ('b', 2), ('a', 3)], trusted=True)
+        MultiMap([('a', 1), ('b', 2), ('a', 3)])
+        >>> MultiMap.from_pairs(['ab', 'cd'])
+        MultiMap([('a', 'b'), ('c', 'd')])
+        >>> MultiMap.from_pairs(['abc'])
+        Traceback (most recent call last):
+        ...
+        ValueError: MultiMap element must have length 2
+        
+        """
+        self = cls()
+        if trusted and cls._conforms_nothing():
+            pairs = list(pairs)
+        else:
+            pairs = self._conform_pairs(pairs)
+        self._set_pairs(pairs)
+        return self
+    
     @classmethod
     def fromkeys(cls, keys, value=None):
-        return cls([(k, value) for k in keys])
+        return cls.from_pairs([(k, value) for k in keys], trusted=True)
     
     def __repr__(self):
-        return '%s(%r)' % (self.__class__.__name__, self._pairs)
+        return '%s(%r)' % (self.__class__.__name__, self.allitems())
     
     def __nonzero__(self):
         """
@@ -118,7 +532,7 @@ class MultiMap(collections.Mapping):
         True
         
         """
-        return bool(self._pairs)
+        return len(self._pairs) > self._dead
     
     def __getitem__(self, key):
         """Get the FIRST value for the given key.
@@ -136,9 +550,10 @@ class MultiMap(collections.Mapping):
         """
         key = self._conform_key(key)
         try:
-            return self._pairs[self._key_ids[key][0]][1]
-        except IndexError:
+            ids = self._key_ids[key]
+        except KeyError:
             raise KeyError(key)
+        return self._pairs[ids[0]][1]
     
     def __contains__(self, key):
         """Is the given key in this mapping?
@@ -149,10 +564,16 @@ class MultiMap(collections.Mapping):
         >>> 'x' in m
         False
         
+        Looking for missing keys does not change the mapping.
+        
+        >>> m.get('y')
+        >>> m.getall('z')
+        []
+        >>> len(m), sorted(m._key_ids)
+        (1, ['a'])
+        
         """
-        # Need to explicitly check the value of the id list, as it may be in
-        # there already but be empty.
-        return bool(self._key_ids[self._conform_key(key)])
+        return self._conform_key(key) in self._key_ids
     
     def has_key(self, key):
         return key in self
@@ -175,7 +596,7 @@ class MultiMap(collections.Mapping):
         6
         
         """
-        return len(self._pairs)
+        return len(self._pairs) - self._dead
     
     def get(self, key, default=None):
         try:
@@ -198,22 +619,251 @@ class MultiMap(collections.Mapping):
         
         """
         key = self._conform_key(key)
-        return [self._pairs[i][1] for i in self._key_ids[key]]
+        return [self._pairs[i][1] for i in self._key_ids.get(key, ())]
     
     # These are for compatibility with other multi-value mapping libraries.
     getlist = list = getall
     
+    # What slices of the pairs view are built as; None means this class.
+    _slice_class = None
+    
+    @property
+    def pairs(self):
+        """A live PairsView of all of the pairs, in order."""
+        return PairsView(self)
+    
+    def count(self, key):
+        """The number of values stored under this key.
+        
+        >>> m = MultiMap([('a', 1), ('b', 2), ('b', 3)])
+        >>> m.count('b'), m.count('x')
+        (2, 0)
+        
+        """
+        return len(self._positions_of(self._conform_key(key)))
+    
+    def index(self, pair, start=0, stop=None):
+        """The position of the first matching pair, like list.index.
+        
+        Only the pairs with the same key are looked at.
+        
+        >>> m = MultiMap([('a', 1), ('b', 2), ('a', 3), ('a', 1)])
+        >>> m.index(('a', 1)), m.index(('a', 1), 1)
+        (0, 3)
+        >>> m.index(('b', 3))
+        Traceback (most recent call last):
+        ...
+        ValueError: ('b', 3) is not in MultiMap
+        
+        """
+        key, value = self._conform_pair(pair)
+        start, stop, step = slice(start, stop).indices(self.alllen())
+        if start < stop:
+            # Search by position in _pairs, which may have tombstones.
+            start = self._stored_index(start)
+            stop = self._stored_index(stop - 1) + 1
+            positions = self._positions_of(key)
+            by_value = self._value_positions(value)
+            if by_value is not None and len(by_value) < len(positions):
+                for i in by_value[bisect_left(by_value, start):]:
+                    if i >= stop:
+                        break
+                    if self._pair_at(i)[0] == key:
+                        return self._order_index(i)
+            else:
+                for i in positions:
+                    if start <= i < stop and self._pair_at(i)[1] == value:
+                        return self._order_index(i)
+        raise ValueError('%r is not in %s' % (pair, self.__class__.__name__))
+    
+    def keysfor(self, value):
+        """A list of the keys which have the given value, in order.
+        
+        Each key is only given once. Without an index of the values (see
+        MutableMultiMap.index_values) all of the pairs are searched.
+        
+        >>> m = MultiMap([('a', 1), ('b', 2), ('c', 1), ('a', 1)])
+        >>> m.keysfor(1), m.keysfor(3)
+        (['a', 'c'], [])
+        
+        """
+        value = self._conform_value(value)
+        positions = self._value_positions(value)
+        if positions is None:
+            keys = (k for k, v in self.iterallitems() if v == value)
+        else:
+            pairs = self._pairs
+            keys = (pairs[i][0] for i in positions)
+        seen = set()
+        found = []
+        for key in keys:
+            if key not in seen:
+                seen.add(key)
+                found.append(key)
+        return found
+    
+    def containsvalue(self, value):
+        """Whether any key has the given value.
+        
+        >>> m = MultiMap([('a', 1), ('b', 2)])
+        >>> m.containsvalue(2), m.containsvalue(3)
+        (True, False)
+        
+        """
+        value = self._conform_value(value)
+        positions = self._value_positions(value)
+        if positions is None:
+            return any(v == value for v in self.iterallvalues())
+        return bool(positions)
+    
+    def __eq__(self, other):
+        """Two MultiMaps are equal if they have the same pairs in the same order.
+        
+        Maps which differ in size or in how many values any key has are told
+        apart without looking at the pairs. Other mappings are compared as a
+        dict would be.
+        
+        >>> m = MultiMap([('a', 1), ('b', 2), ('a', 3)])
+        >>> m == MultiMap([('a', 1), ('b', 2), ('a', 3)])
+        True
+        >>> m == MultiMap([('b', 2), ('a', 1), ('a', 3)])
+        False
+        >>> m == {'a': 1, 'b': 2}
+        True
+        
+        """
+        if not isinstance(other, MultiMap):
+            # A ConcurrentMultiMap compares its snapshot with us instead.
+            if isinstance(other, ConcurrentMultiMap):
+                return NotImplemented
+            return collections.Mapping.__eq__(self, other)
+        if self is other:
+            return True
+        if self.alllen() != other.alllen() or len(self) != len(other):
+            return False
+        counts = self._key_counts()
+        other_counts = other._key_counts()
+        if counts is not None and other_counts is not None and \
+            counts != other_counts:
+            return False
+        return self.allitems() == other.allitems()
+    
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+    
+    def _key_counts(self):
+        """A dict of the number of values under each key.
+        
+        None if that is no cheaper to find than the pairs themselves.
+        
+        """
+        return dict((key, len(ids)) for key, ids in self._key_ids.iteritems())
+    
+    def diff(self, other):
+        """An edit script which turns this map into the other one.
+        
+        The script is a list of (tag, index, count, pairs) edits, where tag
+        is 'insert', 'delete' or 'replace', and each replaces the count pairs
+        at index with the given pairs. Indices are positions in this map as it
+        is, before any of the edits, and are in increasing order. See
+        MutableMultiMap.apply_delta.
+        
+        The pairs common to the start and to the end of both maps are skipped
+        without hashing anything; what is left between them is matched with
+        difflib, or replaced outright if any of its pairs are unhashable.
+        
+        >>> a = MultiMap([('a', 1), ('b', 2), ('c', 3), ('d', 4)])
+        >>> b = MultiMap([('a', 1), ('x', 5), ('c', 3), ('d', 4), ('e', 6)])
+        >>> a.diff(b)
+        [('replace', 1, 1, [('x', 5)]), ('insert', 4, 0, [('e', 6)])]
+        >>> a.diff(a)
+        []
+        
+        """
+        old = self.allitems()
+        new = other.allitems()
+        start = _common_prefix(old, new)
+        if start == len(old) == len(new):
+            return []
+        old = old[start:]
+        new = new[start:]
+        end = _common_prefix(old[::-1], new[::-1])
+        old = old[:len(old) - end]
+        new = new[:len(new) - end]
+        
+        if not old:
+            return [('insert', start, 0, new)]
+        if not new:
+            return [('delete', start, len(old), new)]
+        try:
+            matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+            opcodes = matcher.get_opcodes()
+        except TypeError:
+            opcodes = [('replace', 0, len(old), 0, len(new))]
+        return [(tag, start + i1, i2 - i1, new[j1:j2])
+            for tag, i1, i2, j1, j2 in opcodes if tag != 'equal']
+    
+    def _stored_index(self, index):
+        """The position in _pairs of the pair at the given position in the
+        order (which may be negative).
+        
+        They are only ever different in the mutable maps, while they have
+        tombstones in their pair list.
+        
+        """
+        return index
+    
+    def _order_index(self, i):
+        """The position in the order of the pair at the given position in
+        _pairs; the reverse of _stored_index.
+        
+        """
+        return i
+    
+    def _positions_of(self, key):
+        """The positions in _pairs of the given (conformed) key, in order."""
+        return self._key_ids.get(key, ())
+    
+    def _value_positions(self, value):
+        """The positions of the given (conformed) value in _pairs, in order.
+        
+        None if there is no index of the values to find them with.
+        
+        """
+        return None
+    
+    def _pair_at(self, index):
+        """The pair at the given position in _pairs."""
+        return self._pairs[index]
+    
+    def _pair_slice(self, index):
+        """A list of the pairs in the given slice of the order."""
+        return self._pairs[index]
+    
     def iteritems(self):
         """Iterator across all the non-duplicate keys and their values.
         
-        Only yields the first key of duplicates.
+        Only yields the first key of duplicates. A pair is the first of its
+        key if its position is the first one in the key's list in _key_ids.
+        
+        The views returned by viewkeys, viewvalues and viewitems iterate with
+        this, and use the index for their len and membership tests.
+        
+        >>> m = MultiMap([('a', 1), ('b', 2), ('b', 3), ('c', 4), ('d', 5), ('c', 6)])
+        >>> list(m.iteritems())
+        [('a', 1), ('b', 2), ('c', 4), ('d', 5)]
+        >>> keys = m.viewkeys()
+        >>> len(keys), 'c' in keys, 'x' in keys
+        (4, True, False)
+        >>> ('b', 2) in m.viewitems(), ('b', 3) in m.viewitems()
+        (True, False)
         
         """
-        keys_yielded = set()
-        for k, v in self._pairs:
-            if k not in keys_yielded:
-                keys_yielded.add(k)
-                yield k, v
+        key_ids = self._key_ids
+        for i, pair in enumerate(self._pairs):
+            if pair is not None and key_ids[pair[0]][0] == i:
+                yield pair
                 
     def __iter__(self):
         """Iterate across the unique keys in the mapping."""
@@ -233,9 +883,21 @@ class MultiMap(collections.Mapping):
         """Iterate across the first keys in the mapping."""
         return iter(self)
     
+    def viewkeys(self):
+        """A set-like view of the keys, with O(1) len and membership."""
+        return collections.KeysView(self)
+    
+    def viewvalues(self):
+        """A view of the values for the first keys in the mapping."""
+        return collections.ValuesView(self)
+    
+    def viewitems(self):
+        """A set-like view of the first pairs, with O(1) len and membership."""
+        return collections.ItemsView(self)
+    
     def iterallkeys(self):
         """Iterate across ALL of the keys in the mapping, in order."""
-        for x in self._pairs:
+        for x in self.iterallitems():
             yield x[0]
     
     def allkeys(self):
@@ -246,7 +908,7 @@ class MultiMap(collections.Mapping):
         ['a', 'b', 'b', 'c', 'd', 'c']
         
         """
-        return [x[0] for x in self._pairs]
+        return [x[0] for x in self.iterallitems()]
     
     def items(self):
         """A list of items with the first keys in the mapping.
@@ -274,7 +936,7 @@ class MultiMap(collections.Mapping):
     
     def iterallvalues(self):
         """Iterate across ALL of the values in the mapping."""
-        for x in self._pairs:
+        for x in self.iterallitems():
             yield x[1]
     
     def allvalues(self):
@@ -285,15 +947,173 @@ class MultiMap(collections.Mapping):
         [1, 2, 3, 4, 5, 6]
         
         """
-        return [x[1] for x in self._pairs]
+        return [x[1] for x in self.iterallitems()]
     
     def iterallitems(self):
         """Iterate across ALL of the pairs in the mapping."""
+        if self._dead:
+            return (x for x in self._pairs if x is not None)
         return iter(self._pairs)
     
     def allitems(self):
         """A list of ALL of the pairs in the mapping."""
-        return self._pairs[:]
+        if self._dead:
+            return [x for x in self._pairs if x is not None]
+        return list(self._pairs)
+    
+    def iteritemlists(self):
+        """Iterate across every key with a list of all of its values.
+        
+        Keys are in the order of their first pair, and the values come
+        straight from the index rather than a scan of every pair per key.
+        
+        >>> m = MultiMap([('a', 1), ('b', 2), ('b', 3), ('c', 4), ('d', 5), ('c', 6)])
+        >>> m.itemlists()
+        [('a', [1]), ('b', [2, 3]), ('c', [4, 6]), ('d', [5])]
+        >>> m.lists()
+        [[1], [2, 3], [4, 6], [5]]
+        
+        """
+        pairs = self._pairs
+        key_ids = self._key_ids
+        for key, value in self.iteritems():
+            yield key, [pairs[i][1] for i in key_ids[key]]
+    
+    def itemlists(self):
+        """A list of every key with a list of all of its values."""
+        return list(self.iteritemlists())
+    
+    def iterlists(self):
+        """Iterate across the lists of all values for every key."""
+        return (x[1] for x in self.iteritemlists())
+    
+    def lists(self):
+        """A list of the lists of all values for every key."""
+        return [x[1] for x in self.iteritemlists()]
+    
+    # Incremented by every change to a mutable map; see grouped.
+    _version = 0
+    
+    def grouped(self):
+        """A GroupedView of all values for every key.
+        
+        The view is a snapshot, which is cached until the map is next
+        changed, so repeated calls on an unchanged map cost nothing.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3)])
+        >>> g = m.grouped()
+        >>> g
+        <GroupedView [('a', (1, 3)), ('b', (2,))]>
+        >>> g['a'], m.grouped() is g
+        ((1, 3), True)
+        >>> m.append(('b', 4))
+        >>> m.grouped()['b'], g['b']
+        ((2, 4), (2,))
+        
+        """
+        cached = getattr(self, '_grouped', None)
+        if cached is not None and cached[0] == self._version:
+            return cached[1]
+        view = GroupedView(self.iteritemlists(), self._conform_key)
+        self._grouped = (self._version, view)
+        return view
+    
+    def _flatten(self):
+        """Get the contents as (keys, offsets, positions, values).
+        
+        This is the same layout as CompactMultiMap: the key in slot s of the
+        keys list has its positions at positions[offsets[s]:offsets[s + 1]],
+        both of which are arrays, and values are in pair order.
+        
+        """
+        keys = []
+        offsets = array('l', [0])
+        positions = array('l')
+        for key, ids in self._key_ids.iteritems():
+            keys.append(key)
+            positions.extend(ids)
+            offsets.append(len(positions))
+        values = [x[1] for x in self._pairs]
+        return keys, offsets, positions, values
+    
+    def _set_flat(self, keys, offsets, positions, values):
+        """Take our contents from the form returned by _flatten.
+        
+        Neither conforms the pairs nor rehashes anything but the keys. This
+        is called on a new object which has not been through __init__, so it
+        must set up all of the storage.
+        
+        """
+        key_of = [None] * len(values)
+        self._key_ids = key_ids = {}
+        for slot, key in enumerate(keys):
+            ids = key_ids[key] = positions[offsets[slot]:offsets[slot + 1]].tolist()
+            for i in ids:
+                key_of[i] = key
+        self._pairs = zip(key_of, values)
+    
+    def _public_state(self):
+        """Attributes to carry along when pickling, besides the pairs."""
+        return dict((k, v) for k, v in getattr(self, '__dict__', {}).iteritems()
+            if not k.startswith('_'))
+    
+    def __reduce__(self):
+        """Pickle in the flat form of _flatten.
+        
+        >>> import pickle
+        >>> m = MultiMap([('a', 1), ('b', 2), ('a', 3)])
+        >>> pickle.loads(pickle.dumps(m))
+        MultiMap([('a', 1), ('b', 2), ('a', 3)])
+        
+        """
+        keys, offsets, positions, values = self._flatten()
+        flat = (keys, offsets.itemsize, offsets.tostring(),
+            positions.tostring(), values)
+        return _restore, (self.__class__, flat), self._public_state() or None
+    
+    def to_bytes(self):
+        """Serialize to a string in the flat form of _flatten.
+        
+        The string is a header, the offsets and positions arrays, and then
+        the pickled key table and values. The arrays are in the native byte
+        order, so this is for passing maps between processes on the same
+        machine (e.g. through shared memory), not for storage.
+        
+        >>> m = MultiMap([('a', 1), ('b', 2), ('a', 3)])
+        >>> MultiMap.from_bytes(m.to_bytes())
+        MultiMap([('a', 1), ('b', 2), ('a', 3)])
+        
+        """
+        keys, offsets, positions, values = self._flatten()
+        keys = pickle.dumps(keys, pickle.HIGHEST_PROTOCOL)
+        header = _BYTES_HEADER.pack(_BYTES_MAGIC, offsets.itemsize,
+            len(offsets) - 1, len(positions), len(keys))
+        return ''.join((header, offsets.tostring(), positions.tostring(), keys,
+            pickle.dumps(values, pickle.HIGHEST_PROTOCOL)))
+    
+    @classmethod
+    def from_bytes(cls, data):
+        """Build a mapping from the output of to_bytes.
+        
+        The data may be anything which can be sliced into strings, such as an
+        mmap.
+        
+        """
+        magic, itemsize, key_count, pair_count, keys_size = \
+            _BYTES_HEADER.unpack_from(data)
+        if magic != _BYTES_MAGIC:
+            raise ValueError('not a serialized MultiMap')
+        start = _BYTES_HEADER.size
+        end = start + (key_count + 1) * itemsize
+        offsets = _load_ids(itemsize, data[start:end])
+        start, end = end, end + pair_count * itemsize
+        positions = _load_ids(itemsize, data[start:end])
+        start, end = end, end + keys_size
+        keys = pickle.loads(data[start:end])
+        values = pickle.loads(data[end:])
+        self = cls.__new__(cls)
+        self._set_flat(keys, offsets, positions, values)
+        return self
 
 
 class MutableMultiMap(MultiMap, collections.MutableMapping):
@@ -376,51 +1196,332 @@ class MutableMultiMap(MultiMap, collections.MutableMapping):
     
     """
     
-    def _remove_pairs(self, ids_to_remove):
-        """Remove the pairs identified by the given indices into _pairs.
-        
-        Removes the pair, and updates the _key_ids mapping to be accurate.
-        Removing the ids from the _key_ids is your own responsibility.
+    # Removed pairs are left in _pairs as tombstones until more than this
+    # fraction of the list is dead, and are then compacted out all at once.
+    # Set it to 0 (on the class or an instance) to compact on every removal.
+    compact_threshold = 0.5
+    
+    # Every slot in _pairs before this one is a tombstone, so that
+    # popitem(0) doesn't have to skip over them all every time.
+    _head = 0
+    
+    # The _version and the result of the last call to _tombstones.
+    _tombstone_ids = None
+    
+    # If our _pairs and _key_ids may also be in use by another map (see
+    # freeze and thaw), they must be copied before we change them.
+    _shared = False
+    
+    # What freeze returns. If it is not set, subclasses which override the
+    # conform methods freeze to a subclass of FrozenMultiMap with the same
+    # conform methods.
+    _frozen_class = None
+    
+    # Whether index_values has been called, and the index of the positions of
+    # every value in _pairs (laid out like _key_ids) if it is up to date.
+    # Appending, setting and removing keep it up to date; any other change
+    # drops it, to be rebuilt when it is next needed.
+    _values_indexed = False
+    _value_ids = None
+    
+    # The _version at which the value index last failed to build because
+    # some value is unhashable. Until the next change the pairs are searched
+    # instead of trying again.
+    _unhashable_version = None
+    
+    def _will_change(self, keeps_values=False):
+        """Called before every change to the mapping.
         
-        Params:
-            ids_to_remove -- The indices to remove. MUST be sorted.
+        Changes which keep the value index up to date themselves say so.
         
         """
-        # Remove them.
-        for i in reversed(ids_to_remove):
-            del self._pairs[i]
-        
-        # We use the bisect to tell us how many spots the given index is
-        # shifting up in the list.
-        for ids in self._key_ids.itervalues():
-            for i, id in enumerate(ids):
-                ids[i] -= bisect(ids_to_remove, id)
+        self._version += 1
+        if self._shared:
+            self._unshare()
+        if not keeps_values and self._value_ids is not None:
+            self._value_ids = None
     
-    def _insert_pairs(self, ids_and_pairs):
-        """Insert some new pairs, and keep the _key_ids updated.
-        
-        Params:
-            ids_and_pairs -- A list of (index, (key, value)) tuples.
+    def _unshare(self):
+        """Take our own copies of _pairs and _key_ids."""
+        self._pairs = list(self._pairs)
+        self._key_ids = dict((k, list(v)) for k, v in self._key_ids.iteritems())
+        self._shared = False
+        # The value index may be shared too; it is cheaper to rebuild it when
+        # it is next needed than to copy it now.
+        self._value_ids = None
+    
+    def index_values(self, enabled=True):
+        """Keep an index of the positions of every value.
         
-        """
-        ids_to_insert = [x[0] for x in ids_and_pairs]
+        This makes keysfor, containsvalue and index (of a pair whose key has
+        many values) take time in the number of matching pairs instead of the
+        size of the map, at the cost of another list of positions per value.
+        The values must be hashable; TypeError is raised if they are not. If
+        an unhashable value is added later on, those methods go back to
+        searching the pairs until it is gone.
         
-        # We use the bisect to tell us how many spots the given index is
-        # shifting up in the list.
-        for ids in self._key_ids.itervalues():
-            for i, id in enumerate(ids):
-                ids[i] += bisect(ids_to_insert, id)
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('c', 1)])
+        >>> m.index_values()
+        >>> m.keysfor(1), m.containsvalue(2)
+        (['a', 'c'], True)
+        >>> m.append(('d', 2))
+        >>> del m['b']
+        >>> m.keysfor(2), m._value_ids
+        (['d'], {1: [0, 2], 2: [3]})
         
-        # Do the actual insertion
-        for i, pair in ids_and_pairs:
-            self._pairs.insert(i, pair)
+        """
+        self._value_ids = self._build_value_ids() if enabled else None
+        self._values_indexed = enabled
     
-    def __delitem__(self, key):
-        """Remove all key/value pairs by the given key.
-
-        Raises a KeyError if there are none.
-
-        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('b', 3), ('c', 4), ('d', 5), ('c', 6)])
+    def _build_value_ids(self):
+        value_ids = {}
+        for i, pair in enumerate(self._pairs):
+            if pair is not None:
+                try:
+                    value_ids[pair[1]].append(i)
+                except KeyError:
+                    value_ids[pair[1]] = [i]
+        return value_ids
+    
+    def _value_positions(self, value):
+        if not self._values_indexed:
+            return None
+        if self._value_ids is None:
+            if self._unhashable_version == self._version:
+                return None
+            try:
+                self._value_ids = self._build_value_ids()
+            except TypeError:
+                self._unhashable_version = self._version
+                return None
+        try:
+            return self._value_ids.get(value, ())
+        except TypeError:
+            return None
+    
+    def _index_value(self, value, i):
+        """Add a position of the given value to the value index."""
+        try:
+            ids = self._value_ids.get(value)
+        except TypeError:
+            self._value_ids = None
+            return
+        if ids is None:
+            self._value_ids[value] = [i]
+        elif ids[-1] < i:
+            ids.append(i)
+        else:
+            insort(ids, i)
+    
+    def _unindex_value(self, value, i):
+        """Remove a position of the given value from the value index."""
+        value_ids = self._value_ids
+        if value_ids is None:
+            return
+        try:
+            ids = value_ids[value]
+        except TypeError:
+            self._value_ids = None
+            return
+        if len(ids) == 1:
+            del value_ids[value]
+        else:
+            del ids[bisect_left(ids, i)]
+    
+    def _remove_pairs(self, ids_to_remove):
+        """Remove the pairs identified by the given indices into _pairs.
+        
+        The pairs are replaced by tombstones so that no other index needs to
+        change, and are compacted out once there are enough of them.
+        Removing the ids from the _key_ids is your own responsibility.
+        
+        Params:
+            ids_to_remove -- The indices to remove.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3), ('c', 4)])
+        >>> del m['b']
+        >>> m._pairs
+        [('a', 1), None, ('a', 3), ('c', 4)]
+        >>> m.allitems()
+        [('a', 1), ('a', 3), ('c', 4)]
+        >>> m.alllen()
+        3
+        >>> del m['a']
+        >>> m._pairs
+        [('c', 4)]
+        >>> m['c']
+        4
+        
+        """
+        pairs = self._pairs
+        if self._value_ids is not None:
+            for i in ids_to_remove:
+                self._unindex_value(pairs[i][1], i)
+        for i in ids_to_remove:
+            pairs[i] = None
+        self._dead += len(ids_to_remove)
+        if self._dead > self.compact_threshold * len(pairs):
+            self._compact()
+    
+    def _compact(self):
+        """Remove all tombstones from _pairs, and renumber the _key_ids."""
+        if not self._dead:
+            return
+        if self._shared:
+            self._unshare()
+        
+        # Map every old index to where that pair ends up.
+        new_ids = []
+        pairs = []
+        for pair in self._pairs:
+            new_ids.append(len(pairs))
+            if pair is not None:
+                pairs.append(pair)
+        
+        for ids in self._key_ids.itervalues():
+            if type(ids) is list:
+                for i, id in enumerate(ids):
+                    ids[i] = new_ids[id]
+            else:
+                # Indexing into the middle of a deque isn't O(1).
+                for i in xrange(len(ids)):
+                    ids.append(new_ids[ids.popleft()])
+        if self._value_ids is not None:
+            for ids in self._value_ids.itervalues():
+                for i, id in enumerate(ids):
+                    ids[i] = new_ids[id]
+        
+        self._pairs = pairs
+        self._dead = 0
+        self._head = 0
+    
+    def _tombstones(self):
+        """A sorted list of the positions of the tombstones in _pairs.
+        
+        It is cached until the next change. Compacting doesn't count as one,
+        but leaves nothing for this to be asked about.
+        
+        """
+        cached = self._tombstone_ids
+        if cached is not None and cached[0] == self._version:
+            return cached[1]
+        pairs = self._pairs
+        # Everything before the head is dead; list.index finds the rest.
+        ids = range(self._head)
+        i = self._head - 1
+        try:
+            while True:
+                i = pairs.index(None, i + 1)
+                ids.append(i)
+        except ValueError:
+            pass
+        self._tombstone_ids = (self._version, ids)
+        return ids
+    
+    def _stored_index(self, index):
+        # Reading by position must not compact; reads would then cost O(N),
+        # and take a copy of storage which is shared.
+        if not self._dead:
+            return index
+        size = self.alllen()
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('index out of range')
+        # The pair has as many tombstones before it as the first tombstone
+        # with more live pairs than the index before it.
+        dead = self._tombstones()
+        lo = 0
+        hi = len(dead)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if dead[mid] - mid > index:
+                hi = mid
+            else:
+                lo = mid + 1
+        return index + lo
+    
+    def _order_index(self, i):
+        if not self._dead:
+            return i
+        return i - bisect_left(self._tombstones(), i)
+    
+    def _pair_slice(self, index):
+        if not self._dead:
+            return self._pairs[index]
+        start, stop, step = index.indices(self.alllen())
+        if step != 1:
+            pairs = self._pairs
+            return [pairs[self._stored_index(i)]
+                for i in xrange(start, stop, step)]
+        if start >= stop:
+            return []
+        start = self._stored_index(start)
+        stop = self._stored_index(stop - 1) + 1
+        return [pair for pair in self._pairs[start:stop] if pair is not None]
+    
+    def _flatten(self):
+        # The flat form has no room for tombstones.
+        self._compact()
+        return MultiMap._flatten(self)
+    
+    def _insert_pairs(self, ids_and_pairs):
+        """Insert some new pairs, and keep the _key_ids updated.
+        
+        The pairs are inserted one after the other, with the same handling of
+        the indices as list.insert.
+        
+        Params:
+            ids_and_pairs -- A list of (index, (key, value)) tuples.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2)])
+        >>> m._insert_pairs([(1, ('a', 3)), (-1, ('b', 4)), (10, ('c', 5))])
+        >>> m.allitems()
+        [('a', 1), ('a', 3), ('b', 4), ('b', 2), ('c', 5)]
+        >>> m.getall('a'), m.getall('b')
+        ([1, 3], [4, 2])
+        
+        """
+        # The indices are positions amongst the live pairs.
+        self._compact()
+        
+        pairs = self._pairs
+        for index, pair in ids_and_pairs:
+            if index < 0:
+                index = max(0, index + len(pairs))
+            index = min(index, len(pairs))
+            
+            # Everything at or after the index is shifting up one spot. The
+            # id lists are sorted so we only need to touch their tails.
+            for ids in self._key_ids.itervalues():
+                i = len(ids) - 1
+                while i >= 0 and ids[i] >= index:
+                    ids[i] += 1
+                    i -= 1
+            if self._value_ids is not None:
+                for ids in self._value_ids.itervalues():
+                    i = len(ids) - 1
+                    while i >= 0 and ids[i] >= index:
+                        ids[i] += 1
+                        i -= 1
+            
+            pairs.insert(index, pair)
+            if self._value_ids is not None:
+                self._index_value(pair[1], index)
+            ids = self._key_ids.get(pair[0])
+            if ids is None:
+                self._key_ids[pair[0]] = [index]
+            else:
+                if type(ids) is not list:
+                    ids = self._key_ids[pair[0]] = list(ids)
+                insort(ids, index)
+    
+    def __delitem__(self, key):
+        """Remove all key/value pairs by the given key.
+
+        Raises a KeyError if there are none.
+
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('b', 3), ('c', 4), ('d', 5), ('c', 6)])
         >>> del m['a']
         >>> m
         MutableMultiMap([('b', 2), ('b', 3), ('c', 4), ('d', 5), ('c', 6)])
@@ -448,14 +1549,10 @@ class MutableMultiMap(MultiMap, collections.MutableMapping):
 
         """
         key = self._conform_key(key)
-        del_ids = self._key_ids[key]
-        if not del_ids:
+        if key not in self._key_ids:
             raise KeyError(key)
-
-        # Remove the ids.
-        del self._key_ids[key]
-
-        self._remove_pairs(del_ids)
+        self._will_change(keeps_values=True)
+        self._remove_pairs(self._key_ids.pop(key))
         
     def __setitem__(self, key, value):
         """Set a key-value pair.
@@ -486,7 +1583,10 @@ class MutableMultiMap(MultiMap, collections.MutableMapping):
         self.setall(key, [value])
     
     def clear(self):
+        self._will_change()
         self._pairs = []
+        self._dead = 0
+        self._head = 0
         self._rebuild_key_ids()
         
     def setall(self, key, values):
@@ -506,19 +1606,79 @@ class MutableMultiMap(MultiMap, collections.MutableMapping):
         [('a', 1), ('b', 5), ('c', 3), ('b', 6), ('b', 7)]
         
         """
-        key = self._conform_key(key)
-        values = [self._conform_value(x) for x in values]
-        ids = self._key_ids[key][:]
-        while ids and values:
-            id    = ids.pop(0)
-            value = values.pop(0)
-            self._pairs[id] = (key, value)
-        if ids:
-            self._key_ids[key] = self._key_ids[key][:-len(ids)]
-            self._remove_pairs(ids)
-        for value in values:
-            self._key_ids[key].append(len(self._pairs))
-            self._pairs.append((key, value))
+        self.setall_many([(key, values)])
+    
+    def setall_many(self, mapping):
+        """Set all of the values for several keys at once.
+        
+        Takes a mapping of keys to lists of values, or an iterable of
+        (key, values) pairs, and does the same as setall for each. All of the
+        surplus pairs are removed together at the end.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3), ('c', 4)])
+        >>> m.setall_many([('a', [5]), ('c', [6, 7]), ('d', [8]), ('b', [])])
+        >>> m
+        MutableMultiMap([('a', 5), ('c', 6), ('c', 7), ('d', 8)])
+        
+        Clearing keys which are not there changes nothing, so a copy stays
+        shared and the version stays the same.
+        
+        """
+        if isinstance(mapping, collections.Mapping):
+            mapping = mapping.iteritems()
+        mapping = [(self._conform_key(key),
+            [self._conform_value(x) for x in values]) for key, values in mapping]
+        if not any(values or key in self._key_ids for key, values in mapping):
+            return
+        self._will_change(keeps_values=True)
+        pairs = self._pairs
+        to_remove = []
+        for key, values in mapping:
+            ids = self._key_ids.get(key)
+            if ids is None:
+                if not values:
+                    continue
+                ids = self._key_ids[key] = []
+            count = len(ids)
+            for id, value in zip(ids, values):
+                if self._value_ids is not None:
+                    self._unindex_value(pairs[id][1], id)
+                pairs[id] = (key, value)
+                if self._value_ids is not None:
+                    self._index_value(value, id)
+            if count > len(values):
+                for i in xrange(count - len(values)):
+                    to_remove.append(ids.pop())
+                if not values:
+                    del self._key_ids[key]
+            for value in values[count:]:
+                if self._value_ids is not None:
+                    self._index_value(value, len(pairs))
+                ids.append(len(pairs))
+                pairs.append((key, value))
+        if to_remove:
+            self._remove_pairs(to_remove)
+    
+    def delete_many(self, keys):
+        """Remove all pairs for each of the given keys.
+        
+        Keys which are not in the mapping are ignored, as with discard.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3), ('c', 4)])
+        >>> m.delete_many(['a', 'c', 'x'])
+        >>> m
+        MutableMultiMap([('b', 2)])
+        
+        """
+        keys = [x for x in set(self._conform_key(x) for x in keys)
+            if x in self._key_ids]
+        if not keys:
+            return
+        self._will_change(keeps_values=True)
+        to_remove = []
+        for key in keys:
+            to_remove.extend(self._key_ids.pop(key))
+        self._remove_pairs(to_remove)
     
     def discard(self, key):
         """Same as del m[key], but does not throw an error."""
@@ -526,6 +1686,35 @@ class MutableMultiMap(MultiMap, collections.MutableMapping):
             del self[key]
         except KeyError:
             pass
+    
+    def remove(self, pair):
+        """Remove the first matching pair, like list.remove.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3), ('a', 1)])
+        >>> m.remove(('a', 1))
+        >>> m
+        MutableMultiMap([('b', 2), ('a', 3), ('a', 1)])
+        >>> m.remove(('b', 3))
+        Traceback (most recent call last):
+        ...
+        ValueError: ('b', 3) is not in MutableMultiMap
+        
+        """
+        key, value = self._conform_pair(pair)
+        pairs = self._pairs
+        ids = self._key_ids.get(key, ())
+        for j, i in enumerate(ids):
+            if pairs[i][1] == value:
+                break
+        else:
+            raise ValueError('%r is not in %s' % (pair, self.__class__.__name__))
+        self._will_change(keeps_values=True)
+        ids = self._key_ids[key]
+        if len(ids) == 1:
+            del self._key_ids[key]
+        else:
+            del ids[j]
+        self._remove_pairs([i])
 
     def sort(self, *args, **kwargs):
         """Sort the MultiMap.
@@ -544,25 +1733,227 @@ class MutableMultiMap(MultiMap, collections.MutableMapping):
         >>> m.keys()
         ['c', 'a', 'b']
         
+        The existing lists in _key_ids are emptied and refilled, rather than
+        building a new index.
+        
         """
-        self._pairs.sort(*args, **kwargs)
-        self._rebuild_key_ids()
+        self._will_change()
+        self._compact()
+        pairs = self._pairs
+        pairs.sort(*args, **kwargs)
+        key_ids = self._key_ids
+        for ids in key_ids.itervalues():
+            if type(ids) is list:
+                del ids[:]
+            else:
+                ids.clear()
+        for i, pair in enumerate(pairs):
+            key_ids[pair[0]].append(i)
+    
+    def sort_keys(self, key=None, reverse=False):
+        """Stable sort of the pairs by key alone.
+        
+        Values are never compared, and pairs which sort equal keep their
+        order. The key and reverse arguments are as for list.sort, but key is
+        given only the keys. This is much faster than sort(), since only the
+        unique keys are sorted.
+        
+        >>> m = MutableMultiMap([('b', 3), ('a', 2), ('b', 1), ('a', 4)])
+        >>> m.sort_keys()
+        >>> m
+        MutableMultiMap([('a', 2), ('a', 4), ('b', 3), ('b', 1)])
+        >>> m.sort_keys(reverse=True)
+        >>> m.getall('b'), m.keys()
+        ([3, 1], ['b', 'a'])
+        
+        Different keys which the key function makes equal are not grouped.
+        
+        >>> m = MutableMultiMap([('b', 1), ('A', 2), ('a', 3), ('A', 4)])
+        >>> m.sort_keys(key=str.lower)
+        >>> m
+        MutableMultiMap([('A', 2), ('a', 3), ('A', 4), ('b', 1)])
+        
+        """
+        self._will_change()
+        self._compact()
+        key_ids = self._key_ids
+        groups = _sorted_key_groups(list(self.iterkeys()), key, reverse)
+        order = []
+        for group in groups:
+            if len(group) == 1:
+                order.extend(key_ids[group[0]])
+            else:
+                order.extend(sorted(i for k in group for i in key_ids[k]))
+        pairs = self._pairs
+        pairs[:] = [pairs[i] for i in order]
+        
+        # Every group of keys now has a run of positions.
+        start = 0
+        for group in groups:
+            stop = start
+            for k in group:
+                ids = key_ids[k]
+                stop += len(ids)
+                if type(ids) is list:
+                    del ids[:]
+                else:
+                    ids.clear()
+            if len(group) == 1:
+                ids.extend(xrange(start, stop))
+            else:
+                for i in xrange(start, stop):
+                    key_ids[pairs[i][0]].append(i)
+            start = stop
     
     def reverse(self):
-        self._pairs.reverse()
-        self._rebuild_key_ids()
+        """Reverse the order of the pairs, like list.reverse.
+        
+        The position of every pair is simply mirrored in place in _key_ids.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3)])
+        >>> m.reverse()
+        >>> m, m.getall('a')
+        (MutableMultiMap([('a', 3), ('b', 2), ('a', 1)]), [3, 1])
+        
+        """
+        self._will_change()
+        self._compact()
+        pairs = self._pairs
+        pairs.reverse()
+        last = len(pairs) - 1
+        for ids in self._key_ids.itervalues():
+            ids.reverse()
+            if type(ids) is list:
+                for j, i in enumerate(ids):
+                    ids[j] = last - i
+            else:
+                for j in xrange(len(ids)):
+                    ids.append(last - ids.popleft())
     
     def insert(self, index, pair):
+        self._will_change(keeps_values=True)
         self._insert_pairs([(index, self._conform_pair(pair))])
         
     def append(self, pair):
+        self._will_change(keeps_values=True)
         key, value = pair = self._conform_pair(pair)
-        self._key_ids[key].append(len(self._pairs))
+        try:
+            self._key_ids[key].append(len(self._pairs))
+        except KeyError:
+            self._key_ids[key] = [len(self._pairs)]
+        if self._value_ids is not None:
+            self._index_value(value, len(self._pairs))
         self._pairs.append(pair)
     
     def extend(self, pairs):
-        for pair in pairs:
-            self.append(pair)
+        self._will_change(keeps_values=True)
+        pairs = [self._conform_pair(x) for x in pairs]
+        key_ids = self._key_ids
+        for i, pair in enumerate(pairs, len(self._pairs)):
+            try:
+                key_ids[pair[0]].append(i)
+            except KeyError:
+                key_ids[pair[0]] = [i]
+            if self._value_ids is not None:
+                self._index_value(pair[1], i)
+        self._pairs.extend(pairs)
+    
+    def insert_many(self, ids_and_pairs):
+        """Insert several pairs with a single rebuild.
+        
+        Unlike a sequence of inserts, every index is a position in the
+        mapping as it was before any of them. Pairs given the same index
+        end up in the order they were given. Indices are otherwise
+        handled the same as list.insert.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('c', 3)])
+        >>> m.insert_many([(2, ('x', 4)), (0, ('y', 5)), (2, ('a', 6)), (-1, ('z', 7))])
+        >>> m
+        MutableMultiMap([('y', 5), ('a', 1), ('b', 2), ('x', 4), ('a', 6), ('z', 7), ('c', 3)])
+        >>> m.getall('a')
+        [1, 6]
+        
+        """
+        self._will_change()
+        old = self.allitems()
+        inserts = []
+        for index, pair in ids_and_pairs:
+            if index < 0:
+                index = max(0, index + len(old))
+            inserts.append((min(index, len(old)), self._conform_pair(pair)))
+        inserts.sort(key=itemgetter(0))
+        
+        pairs = []
+        start = 0
+        for index, pair in inserts:
+            pairs.extend(old[start:index])
+            pairs.append(pair)
+            start = index
+        pairs.extend(old[start:])
+        
+        self._pairs = pairs
+        self._dead = 0
+        self._head = 0
+        self._rebuild_key_ids()
+    
+    def _spliced(self, old, delta):
+        """A new list of the given pairs with the edits of a delta made."""
+        pairs = []
+        start = 0
+        for tag, index, count, new in delta:
+            if index < start or index + count > len(old):
+                raise ValueError('delta does not fit this %s' %
+                    self.__class__.__name__)
+            pairs.extend(old[start:index])
+            pairs.extend(self._conform_pairs(new))
+            start = index + count
+        pairs.extend(old[start:])
+        return pairs
+    
+    def apply_delta(self, delta):
+        """Make the edits of a delta from MultiMap.diff, all at once.
+        
+        The delta must have come from a map with the same pairs as this one.
+        Every position before the first edit is left alone, and the positions
+        from there on are renumbered in a single pass, instead of once per
+        edit as a series of inserts and removals would.
+        
+        >>> a = MutableMultiMap([('a', 1), ('b', 2), ('c', 3), ('a', 4)])
+        >>> b = MultiMap([('a', 1), ('c', 3), ('a', 5), ('a', 4), ('d', 6)])
+        >>> a.apply_delta(a.diff(b))
+        >>> a
+        MutableMultiMap([('a', 1), ('c', 3), ('a', 5), ('a', 4), ('d', 6)])
+        >>> a.getall('a')
+        [1, 5, 4]
+        
+        """
+        delta = list(delta)
+        if not delta:
+            return
+        self._compact()
+        pairs = self._spliced(self._pairs, delta)
+        self._will_change()
+        
+        first = delta[0][1]
+        key_ids = self._key_ids
+        emptied = []
+        for key, ids in key_ids.iteritems():
+            if type(ids) is not list:
+                ids = key_ids[key] = list(ids)
+            del ids[bisect_left(ids, first):]
+            if not ids:
+                emptied.append(key)
+        for key in emptied:
+            del key_ids[key]
+        for i in xrange(first, len(pairs)):
+            key = pairs[i][0]
+            try:
+                key_ids[key].append(i)
+            except KeyError:
+                key_ids[key] = [i]
+        
+        self._pairs = pairs
+        self._head = 0
     
     def pop(self, key, *default):
         """Remove specified key and return the corresponding value.
@@ -615,17 +2006,36 @@ class MutableMultiMap(MultiMap, collections.MutableMapping):
         'default'
         
         """
-        try:
-            value = self[key]
-        except KeyError:
+        key = self._conform_key(key)
+        ids = self._key_ids.get(key)
+        if ids is None:
             if default:
                 return default[0]
-            raise
+            raise KeyError(key)
+        value = self._pairs[ids[0]][1]
         
         # Delete this one.
-        self._remove_pairs([self._key_ids[self._conform_key(key)].pop(0)])
+        self._will_change(keeps_values=True)
+        self._remove_pairs([self._popleft_id(key)])
         
         return value
+    
+    def _popleft_id(self, key):
+        """Remove the first position of the given key from _key_ids.
+        
+        Returns the position.
+        
+        """
+        ids = self._key_ids[key]
+        if len(ids) == 1:
+            del self._key_ids[key]
+            return ids[0]
+        if type(ids) is list:
+            # Popping from the front of a list is O(len), so switch this key
+            # over to a deque. Only keys used like a queue pay for the bigger
+            # object.
+            ids = self._key_ids[key] = collections.deque(ids)
+        return ids.popleft()
 
     def popall(self, key):
         """Remove specified key and return all corresponding values.
@@ -649,99 +2059,3106 @@ class MutableMultiMap(MultiMap, collections.MutableMapping):
         return values
 
     def popitem(self, index=-1):
-        """Remove and return an item at index (default last)."""
-        return self._pairs.pop(index)
-
-
+        """Remove and return an item at index (default last).
+        
+        Popping from either end is O(1) (amortized, at the front). Popping
+        from anywhere else costs about as much as inserting there.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3), ('c', 4), ('b', 5)])
+        >>> m.popitem(), m.popitem(0), m.popitem(1)
+        (('b', 5), ('a', 1), ('a', 3))
+        >>> m, m['a']
+        Traceback (most recent call last):
+        ...
+        KeyError: 'a'
+        >>> m.getall('b'), m['c']
+        ([2], 4)
+        >>> m.popitem(2)
+        Traceback (most recent call last):
+        ...
+        IndexError: popitem index out of range
+        >>> m.popitem(-2), m.popitem(-1)
+        (('b', 2), ('c', 4))
+        >>> m.popitem()
+        Traceback (most recent call last):
+        ...
+        IndexError: pop from empty MultiMap
+        
+        """
+        size = self.alllen()
+        if not size:
+            raise IndexError('pop from empty MultiMap')
+        if index < 0:
+            index += size
+        if index < 0 or index >= size:
+            raise IndexError('popitem index out of range')
+        
+        self._will_change(keeps_values=True)
+        pairs = self._pairs
+        
+        if index == size - 1:
+            # The last pair is always the last position of its key.
+            while pairs[-1] is None:
+                pairs.pop()
+                self._dead -= 1
+            pair = pairs.pop()
+            if self._value_ids is not None:
+                self._unindex_value(pair[1], len(pairs))
+            ids = self._key_ids[pair[0]]
+            ids.pop()
+            if not ids:
+                del self._key_ids[pair[0]]
+            return pair
+        
+        if index == 0:
+            # And the first is the first position of its key.
+            i = self._head
+            while pairs[i] is None:
+                i += 1
+            pair = pairs[i]
+            self._popleft_id(pair[0])
+            self._head = i + 1
+            self._remove_pairs([i])
+            return pair
+        
+        # Anywhere else, the pair is taken out of the list instead of leaving
+        # a tombstone, so that the next call doesn't have to compact again.
+        self._compact()
+        pairs = self._pairs
+        pair = pairs.pop(index)
+        ids = self._key_ids[pair[0]]
+        if len(ids) == 1:
+            del self._key_ids[pair[0]]
+        else:
+            ids.remove(index)
+        if self._value_ids is not None:
+            self._unindex_value(pair[1], index)
+        
+        # Everything after the index has shifted down one spot. As in
+        # _insert_pairs, only the tails of the id lists need to change.
+        for ids in self._key_ids.itervalues():
+            i = len(ids) - 1
+            while i >= 0 and ids[i] > index:
+                ids[i] -= 1
+                i -= 1
+        if self._value_ids is not None:
+            for ids in self._value_ids.itervalues():
+                i = len(ids) - 1
+                while i >= 0 and ids[i] > index:
+                    ids[i] -= 1
+                    i -= 1
+        return pair
 
     def update(self, mapping):
-        for k in mapping:
-            self[k] = mapping[k]
+        self.setall_many((k, [mapping[k]]) for k in mapping)
     
     def copy(self):
-        return self.__class__(self._pairs[:])
+        """Get a shallow copy of the mapping.
+        
+        The copy shares this one's storage until either of them is changed,
+        at which point the one being changed takes its own copy. Pairs are
+        not conformed again.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3)])
+        >>> c = m.copy()
+        >>> c._pairs is m._pairs
+        True
+        >>> c['b'] = 4
+        >>> c
+        MutableMultiMap([('a', 1), ('b', 4), ('a', 3)])
+        >>> m
+        MutableMultiMap([('a', 1), ('b', 2), ('a', 3)])
+        
+        """
+        copy = self.__class__.__new__(self.__class__)
+        copy.__dict__.update(self.__dict__)
+        copy._shared = self._shared = True
+        return copy
+    
+    def freeze(self):
+        """Get a FrozenMultiMap with the same pairs.
+        
+        The frozen map shares this one's storage until this one is next
+        changed, so freezing is O(1) if there is nothing to compact. It is
+        not made through __init__, but gets the same public attributes (as
+        pickling does), and conforms as this map does; see _frozen_class.
+        
+        >>> m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3)])
+        >>> f = m.freeze()
+        >>> f
+        FrozenMultiMap([('a', 1), ('b', 2), ('a', 3)])
+        >>> m.append(('c', 4))
+        >>> del m['a']
+        >>> f, f.getall('a')
+        (FrozenMultiMap([('a', 1), ('b', 2), ('a', 3)]), [1, 3])
+        >>> m
+        MutableMultiMap([('b', 2), ('c', 4)])
+        
+        """
+        self._compact()
+        cls = self._frozen_class or _conforming_class(self.__class__,
+            FrozenMultiMap, 'Frozen')
+        frozen = cls.__new__(cls)
+        frozen.__dict__.update(self._public_state())
+        frozen._pairs = self._pairs
+        frozen._key_ids = self._key_ids
+        self._shared = True
+        return frozen
+
 
+class _Node(object):
+    """A single pair in a LinkedMutableMultiMap, and the block it is in."""
+    
+    __slots__ = ('block', 'key', 'value')
 
 
-class DelayedTraits(object):
-    def __init__(self, supplier=None):
-        self.supplier = supplier
-        self._setup = False
+class _Block(object):
+    """A run of consecutive nodes in a LinkedMutableMultiMap.
+    
+    Blocks (like nodes) compare by identity, so finding one in a list is a
+    scan in C which never compares contents.
+    
+    """
+    
+    __slots__ = ('nodes', )
+    
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+
+class LinkedMutableMultiMap(MutableMultiMap):
+    """A MutableMultiMap which stores its pairs in a list of blocks.
+    
+    Every pair is a node which knows the block it is in, and the key index
+    holds the nodes instead of positions, so nothing needs to be renumbered
+    when pairs are inserted or removed. Finding a position is a bisect over
+    the start of every block, so inserting or removing anywhere costs
+    O(block_size) for the list operation within a block, plus O(N /
+    block_size) to find the starts again, instead of a rewrite of the whole
+    index. Removal by key costs that for each of the key's values.
+    
+    Use it in place of a MutableMultiMap where insert() is common. The _pairs
+    and _key_ids of the normal representation are built on demand (and cached
+    until the next change) for the methods which still need them. The value
+    index (see index_values) holds nodes too, in _value_nodes.
+    
+    >>> m = LinkedMutableMultiMap([('a', 1), ('b', 2), ('a', 3)])
+    >>> m.insert(1, ('c', 4))
+    >>> m.insert(-1, ('a', 5))
+    >>> m
+    LinkedMutableMultiMap([('a', 1), ('c', 4), ('b', 2), ('a', 5), ('a', 3)])
+    >>> m.getall('a')
+    [1, 5, 3]
+    >>> m.popone('a')
+    1
+    >>> del m['b']
+    >>> m.setall('a', [6, 7, 8])
+    >>> m.allitems()
+    [('c', 4), ('a', 6), ('a', 7), ('a', 8)]
+    >>> m.popitem(1)
+    ('a', 6)
+    >>> m.popitem()
+    ('a', 8)
+    >>> m.sort(reverse=True)
+    >>> m
+    LinkedMutableMultiMap([('c', 4), ('a', 7)])
+    >>> len(m), m.alllen()
+    (2, 2)
+    
+    """
+    
+    # How many nodes a block is built with. Blocks are split in two once they
+    # have twice this many, and merged with the next one once they have less
+    # than a quarter of it.
+    block_size = 512
+    
+    # The nodes of every value, in order, if index_values has been called and
+    # it is up to date. Reordering the nodes drops it, to be rebuilt when it is
+    # next needed.
+    _value_nodes = None
+    
+    def __init__(self, *args, **kwargs):
+        self._blocks = []
+        self._starts = None
+        self._nodes = {}
+        self._size = 0
         self.__pairs = None
         self.__key_ids = None
-            
+        MutableMultiMap.__init__(self, *args, **kwargs)
+    
     @property
     def _pairs(self):
         if self.__pairs is None:
-            self.__pairs = [(self._conform_key(k), self._conform_value(v)) for
-                k, v in self.supplier()]
+            self.__pairs = [(x.key, x.value) for x in self._iternodes()]
         return self.__pairs
     
     @_pairs.setter
     def _pairs(self, value):
+        # The blocks are rebuilt from this by the following _rebuild_key_ids.
         self.__pairs = value
     
     @property
     def _key_ids(self):
         if self.__key_ids is None:
-            self._rebuild_key_ids()
+            positions = {}
+            for i, node in enumerate(self._iternodes()):
+                positions.setdefault(node.key, []).append(i)
+            self.__key_ids = positions
         return self.__key_ids
     
     @_key_ids.setter
     def _key_ids(self, value):
         self.__key_ids = value
-
-
-class DelayedMultiMap(DelayedTraits, MultiMap):
-    """
-    >>> def gen():
-    ...     print 'generating'
-    ...     for x in range(5):
-    ...         yield (x, 'x')
-    >>> m = DelayedMultiMap(gen)
-    >>> m[0]
-    generating
-    'x'
-    >>> m[5] = 'new'
-    Traceback (most recent call last):
-    ...
-    TypeError: 'DelayedMultiMap' object does not support item assignment
-
-    """
     
-    pass
-
-class DelayedMutableMultiMap(DelayedTraits, MutableMultiMap):
-    """
-    >>> def gen():
-    ...     print 'generating'
-    ...     for x in range(5):
-    ...         yield (x, 'x')
-    >>> m = DelayedMutableMultiMap(gen)
-    >>> m[0]
-    generating
-    'x'
-    >>> m[5] = 'new'
-    >>> m
-    DelayedMutableMultiMap([(0, 'x'), (1, 'x'), (2, 'x'), (3, 'x'), (4, 'x'), (5, 'new')])
+    def _rebuild_key_ids(self):
+        """Rebuild the blocks from the pairs set on _pairs."""
+        nodes = []
+        key_nodes = self._nodes = {}
+        for pair in self.__pairs:
+            if pair is not None:
+                node = _Node()
+                node.key, node.value = pair
+                nodes.append(node)
+                key_nodes.setdefault(node.key, []).append(node)
+        self._relink(nodes)
     
-    """
+    def _set_flat(self, keys, offsets, positions, values):
+        MutableMultiMap._set_flat(self, keys, offsets, positions, values)
+        self._rebuild_key_ids()
     
-    pass
-
-
-def test_conform_methods():
-    class CaseInsensitive(MutableMultiMap):
-        def _conform_key(self, key):
-            return key.lower()
-    d = CaseInsensitive()
-    d['a'] = 1
-    d['A'] = 2
-    assert len(d) == 1
-    assert d['a'] == 2
-    d['Content-Encoding'] = 'deflate'
-    assert 'content-encoding' in d
-    assert 'blah' not in d
+    def _changed(self):
+        """Drop the cached _pairs and _key_ids."""
+        self._version += 1
+        self.__pairs = None
+        self.__key_ids = None
+    
+    def _iternodes(self):
+        for block in self._blocks:
+            for node in block.nodes:
+                yield node
+    
+    def _block_starts(self):
+        """The position of the first node of every block.
+        
+        It is cached until the sizes of the blocks next change.
+        
+        """
+        starts = self._starts
+        if starts is None:
+            starts = self._starts = []
+            start = 0
+            for block in self._blocks:
+                starts.append(start)
+                start += len(block.nodes)
+        return starts
+    
+    def _node_at(self, index):
+        """Find the node at the given position."""
+        if index < 0:
+            index += self._size
+        if index < 0 or index >= self._size:
+            raise IndexError('index out of range')
+        starts = self._block_starts()
+        k = bisect_right(starts, index) - 1
+        return self._blocks[k].nodes[index - starts[k]]
+    
+    def _position(self, node):
+        """The position of the given node."""
+        block = node.block
+        return (self._block_starts()[self._blocks.index(block)] +
+            block.nodes.index(node))
+    
+    def _link(self, key, value):
+        """Create a node at the end of the order, and add it to _nodes."""
+        node = _Node()
+        node.key = key
+        node.value = value
+        blocks = self._blocks
+        if not blocks or len(blocks[-1].nodes) >= self.block_size:
+            blocks.append(_Block([]))
+            self._starts = None
+        node.block = block = blocks[-1]
+        block.nodes.append(node)
+        self._size += 1
+        self._nodes.setdefault(key, []).append(node)
+        self._index_node(node)
+        return node
+    
+    def _bisect_nodes(self, nodes, index):
+        """Where a node at the given position goes amongst the given nodes
+        (which are in order), by their positions before it is added.
+        
+        """
+        lo = 0
+        hi = len(nodes)
+        if hi and self._position(nodes[-1]) < index:
+            return hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._position(nodes[mid]) < index:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    
+    def _insert_node(self, index, key, value):
+        """Create a node before the given position, like list.insert, and
+        put it into the right place in _nodes.
+        
+        """
+        if index < 0:
+            index = max(0, index + self._size)
+        if index >= self._size:
+            return self._link(key, value)
+        
+        nodes = self._nodes.get(key)
+        if nodes is None:
+            nodes = self._nodes[key] = []
+        lo = self._bisect_nodes(nodes, index)
+        
+        node = _Node()
+        node.key = key
+        node.value = value
+        self._index_node(node, index)
+        starts = self._block_starts()
+        k = bisect_right(starts, index) - 1
+        block = self._blocks[k]
+        node.block = block
+        block.nodes.insert(index - starts[k], node)
+        nodes.insert(lo, node)
+        self._size += 1
+        self._starts = None
+        
+        if len(block.nodes) > 2 * self.block_size:
+            half = len(block.nodes) // 2
+            split = _Block(block.nodes[half:])
+            del block.nodes[half:]
+            for x in split.nodes:
+                x.block = split
+            self._blocks.insert(k + 1, split)
+        return node
+    
+    def _unlink(self, node):
+        """Take the node out of its block; removing it from _nodes is the
+        caller's responsibility.
+        
+        """
+        self._unindex_node(node)
+        block = node.block
+        nodes = block.nodes
+        nodes.remove(node)
+        self._size -= 1
+        self._starts = None
+        blocks = self._blocks
+        if not nodes:
+            blocks.remove(block)
+        elif len(nodes) < self.block_size // 4:
+            k = blocks.index(block)
+            if k + 1 < len(blocks):
+                after = blocks[k + 1]
+                if len(nodes) + len(after.nodes) <= self.block_size:
+                    for x in after.nodes:
+                        x.block = block
+                    nodes.extend(after.nodes)
+                    del blocks[k + 1]
+    
+    def _relink(self, nodes):
+        """Rebuild the blocks from the given nodes, which must be all of them."""
+        nodes = list(nodes)
+        size = self.block_size
+        blocks = self._blocks = []
+        for start in xrange(0, len(nodes), size):
+            block = _Block(nodes[start:start + size])
+            for node in block.nodes:
+                node.block = block
+            blocks.append(block)
+        self._size = len(nodes)
+        self._starts = None
+        self._value_nodes = None
+        self._changed()
+    
+    def sort(self, cmp=None, key=None, reverse=False):
+        nodes = list(self._iternodes())
+        if key is None:
+            pair_key = lambda node: (node.key, node.value)
+        else:
+            pair_key = lambda node: key((node.key, node.value))
+        nodes.sort(cmp=cmp, key=pair_key, reverse=reverse)
+        for key_nodes in self._nodes.itervalues():
+            del key_nodes[:]
+        for node in nodes:
+            self._nodes[node.key].append(node)
+        self._relink(nodes)
+    
+    def sort_keys(self, key=None, reverse=False):
+        key_nodes = self._nodes
+        groups = _sorted_key_groups(list(self.iterkeys()), key, reverse)
+        if all(len(group) == 1 for group in groups):
+            self._relink(node for group in groups for node in key_nodes[group[0]])
+            return
+        order = dict((id(node), i) for i, node in enumerate(self._iternodes()))
+        nodes = []
+        for group in groups:
+            group_nodes = [node for k in group for node in key_nodes[k]]
+            if len(group) > 1:
+                group_nodes.sort(key=lambda node: order[id(node)])
+            nodes.extend(group_nodes)
+        self._relink(nodes)
+    
+    def reverse(self):
+        for key_nodes in self._nodes.itervalues():
+            key_nodes.reverse()
+        nodes = list(self._iternodes())
+        nodes.reverse()
+        self._relink(nodes)
+    
+    def _remove_pairs(self, ids_to_remove):
+        pairs = list(self._pairs)
+        for i in ids_to_remove:
+            pairs[i] = None
+        self._pairs = pairs
+        self._rebuild_key_ids()
+    
+    def _insert_pairs(self, ids_and_pairs):
+        for index, pair in ids_and_pairs:
+            self._insert_node(index, pair[0], pair[1])
+        self._changed()
+    
+    def apply_delta(self, delta):
+        delta = list(delta)
+        if delta:
+            pairs = self._spliced(self.allitems(), delta)
+            self._will_change()
+            self._pairs = pairs
+            self._rebuild_key_ids()
+    
+    def __getitem__(self, key):
+        key = self._conform_key(key)
+        try:
+            return self._nodes[key][0].value
+        except (KeyError, IndexError):
+            raise KeyError(key)
+    
+    def __contains__(self, key):
+        return bool(self._nodes.get(self._conform_key(key)))
+    
+    def __len__(self):
+        return len(self._nodes)
+    
+    def __nonzero__(self):
+        return bool(self._size)
+    
+    def alllen(self):
+        return self._size
+    
+    def _key_counts(self):
+        return dict((key, len(nodes)) for key, nodes in self._nodes.iteritems())
+    
+    def getall(self, key):
+        return [x.value for x in self._nodes.get(self._conform_key(key), ())]
+    
+    getlist = list = getall
+    
+    def iteritems(self):
+        nodes = self._nodes
+        for node in self._iternodes():
+            if nodes[node.key][0] is node:
+                yield node.key, node.value
+    
+    def iterallitems(self):
+        return ((x.key, x.value) for x in self._iternodes())
+    
+    def allitems(self):
+        return list(self.iterallitems())
+    
+    def __delitem__(self, key):
+        key = self._conform_key(key)
+        try:
+            nodes = self._nodes.pop(key)
+        except KeyError:
+            raise KeyError(key)
+        for node in nodes:
+            self._unlink(node)
+        self._changed()
+    
+    def clear(self):
+        self._pairs = []
+        self._rebuild_key_ids()
+    
+    def setall(self, key, values):
+        key = self._conform_key(key)
+        values = [self._conform_value(x) for x in values]
+        nodes = self._nodes.get(key, [])
+        if not nodes and not values:
+            return
+        for node, value in zip(nodes, values):
+            if self._value_nodes is None:
+                node.value = value
+            else:
+                self._unindex_node(node)
+                node.value = value
+                self._index_node(node, self._position(node))
+        for node in nodes[len(values):]:
+            self._unlink(node)
+        if len(nodes) > len(values):
+            if values:
+                del nodes[len(values):]
+            else:
+                del self._nodes[key]
+        for value in values[len(nodes):]:
+            self._link(key, value)
+        self._changed()
+    
+    def insert(self, index, pair):
+        """Insert a pair before the given position, like list.insert."""
+        key, value = self._conform_pair(pair)
+        self._insert_node(index, key, value)
+        self._changed()
+    
+    def append(self, pair):
+        key, value = self._conform_pair(pair)
+        self._link(key, value)
+        self._changed()
+    
+    def extend(self, pairs):
+        for pair in pairs:
+            self.append(pair)
+    
+    def setall_many(self, mapping):
+        if isinstance(mapping, collections.Mapping):
+            mapping = mapping.iteritems()
+        for key, values in mapping:
+            self.setall(key, values)
+    
+    def delete_many(self, keys):
+        for key in keys:
+            self.discard(key)
+    
+    def popone(self, key, *default):
+        key = self._conform_key(key)
+        nodes = self._nodes.get(key)
+        if not nodes:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        node = nodes.pop(0)
+        if not nodes:
+            del self._nodes[key]
+        self._unlink(node)
+        self._changed()
+        return node.value
+    
+    def copy(self):
+        copy = self.__class__(self.allitems())
+        if self._values_indexed:
+            copy._values_indexed = True
+        return copy
+    
+    def count(self, key):
+        return len(self._nodes.get(self._conform_key(key), ()))
+    
+    def index_values(self, enabled=True):
+        self._value_nodes = self._build_value_nodes() if enabled else None
+        self._values_indexed = enabled
+    
+    def _build_value_nodes(self):
+        value_nodes = {}
+        for node in self._iternodes():
+            try:
+                value_nodes[node.value].append(node)
+            except KeyError:
+                value_nodes[node.value] = [node]
+        return value_nodes
+    
+    def _value_nodes_of(self, value):
+        """The nodes with the given (conformed) value, in order.
+        
+        None if the values are not indexed, or can't be.
+        
+        """
+        if not self._values_indexed:
+            return None
+        if self._value_nodes is None:
+            if self._unhashable_version == self._version:
+                return None
+            try:
+                self._value_nodes = self._build_value_nodes()
+            except TypeError:
+                self._unhashable_version = self._version
+                return None
+        try:
+            return self._value_nodes.get(value, ())
+        except TypeError:
+            return None
+    
+    def _value_positions(self, value):
+        # The index holds nodes, which the methods using it look at directly.
+        return None
+    
+    def _index_node(self, node, index=None):
+        """Add the node to the value index, at the given position (before it
+        is added), or at the end.
+        
+        """
+        value_nodes = self._value_nodes
+        if value_nodes is None:
+            return
+        try:
+            nodes = value_nodes.get(node.value)
+        except TypeError:
+            self._value_nodes = None
+            return
+        if nodes is None:
+            value_nodes[node.value] = [node]
+        elif index is None:
+            nodes.append(node)
+        else:
+            nodes.insert(self._bisect_nodes(nodes, index), node)
+    
+    def _unindex_node(self, node):
+        """Remove the node from the value index."""
+        value_nodes = self._value_nodes
+        if value_nodes is None:
+            return
+        try:
+            nodes = value_nodes[node.value]
+        except TypeError:
+            self._value_nodes = None
+            return
+        if len(nodes) == 1:
+            del value_nodes[node.value]
+        else:
+            nodes.remove(node)
+    
+    def keysfor(self, value):
+        nodes = self._value_nodes_of(self._conform_value(value))
+        if nodes is None:
+            return MutableMultiMap.keysfor(self, value)
+        seen = set()
+        found = []
+        for node in nodes:
+            if node.key not in seen:
+                seen.add(node.key)
+                found.append(node.key)
+        return found
+    
+    def containsvalue(self, value):
+        nodes = self._value_nodes_of(self._conform_value(value))
+        if nodes is None:
+            return MutableMultiMap.containsvalue(self, value)
+        return bool(nodes)
+    
+    def index(self, pair, start=0, stop=None):
+        # Only the positions of the candidates are found, instead of building
+        # _key_ids.
+        key, value = self._conform_pair(pair)
+        start, stop, step = slice(start, stop).indices(self._size)
+        nodes = self._nodes.get(key, ())
+        by_value = self._value_nodes_of(value)
+        if by_value is not None and len(by_value) < len(nodes):
+            found = (x for x in by_value if x.key == key)
+        else:
+            found = (x for x in nodes if x.value == value)
+        if start < stop:
+            for node in found:
+                i = self._position(node)
+                if i >= stop:
+                    break
+                if i >= start:
+                    return i
+        raise ValueError('%r is not in %s' % (pair, self.__class__.__name__))
+    
+    def _pair_at(self, index):
+        node = self._node_at(index)
+        return node.key, node.value
+    
+    def remove(self, pair):
+        key, value = self._conform_pair(pair)
+        nodes = self._nodes.get(key, ())
+        for j, node in enumerate(nodes):
+            if node.value == value:
+                break
+        else:
+            raise ValueError('%r is not in %s' % (pair, self.__class__.__name__))
+        if len(nodes) == 1:
+            del self._nodes[key]
+        else:
+            del nodes[j]
+        self._unlink(node)
+        self._changed()
+    
+    def popitem(self, index=-1):
+        """Remove and return an item at index (default last)."""
+        node = self._node_at(index)
+        nodes = self._nodes[node.key]
+        if len(nodes) == 1:
+            del self._nodes[node.key]
+        elif nodes[-1] is node:
+            nodes.pop()
+        else:
+            # Nodes compare by identity, so this finds the right one.
+            nodes.remove(node)
+        self._unlink(node)
+        self._changed()
+        return node.key, node.value
+
+
+class CompactMultiMap(MultiMap):
+    """A read-only MultiMap laid out to use as little memory as possible.
+    
+    Instead of a tuple per pair and a list of positions per key, the keys and
+    values are kept in two parallel lists (every pair with the same key
+    shares one key object), and the positions of all keys are kept together
+    in one flat array. The positions of the key in slot s are
+    _positions[_offsets[s]:_offsets[s + 1]]. Pairs are only built as tuples
+    when they are asked for.
+    
+    On 64-bit CPython 2.7, with 100k pairs spread over 10k keys, a MultiMap
+    takes roughly 133 bytes per pair while a CompactMultiMap takes roughly 36
+    (not counting the keys and values themselves). Most of the difference is
+    the 2-tuple per pair (72 bytes) and the int object for each position (24
+    bytes).
+    
+    Its own attributes are kept in __slots__, so an instance has no __dict__
+    allocated (another 280 bytes per map) unless something else is stored on
+    it. It cannot do without one entirely: the collections ABCs which
+    MultiMap derives from have no __slots__ in Python 2, so other attributes
+    can still be set.
+    
+    >>> m = CompactMultiMap([('a', 1), ('b', 2), ('b', 3), ('c', 4), ('d', 5), ('c', 6)])
+    >>> m
+    CompactMultiMap([('a', 1), ('b', 2), ('b', 3), ('c', 4), ('d', 5), ('c', 6)])
+    >>> m['c'], m.getall('c'), m.getall('x')
+    (4, [4, 6], [])
+    >>> m.items()
+    [('a', 1), ('b', 2), ('c', 4), ('d', 5)]
+    >>> len(m), m.alllen()
+    (4, 6)
+    >>> 'd' in m, 'x' in m
+    (True, False)
+    
+    """
+    
+    __slots__ = ('_keys', '_values', '_slots', '_offsets', '_positions',
+        '_grouped')
+    
+    def _set_pairs(self, pairs):
+        """Build the compact layout from an iterable of conformed pairs."""
+        self._keys = keys = []
+        self._values = values = []
+        self._slots = slots = {}
+        pair_slots = array('l')
+        counts = []
+        first_keys = []
+        for key, value in pairs:
+            slot = slots.get(key)
+            if slot is None:
+                slot = slots[key] = len(counts)
+                counts.append(0)
+                first_keys.append(key)
+            else:
+                # Share one object between all pairs with the same key.
+                key = first_keys[slot]
+            counts[slot] += 1
+            pair_slots.append(slot)
+            keys.append(key)
+            values.append(value)
+        
+        self._offsets = offsets = array('l', [0])
+        for count in counts:
+            offsets.append(offsets[-1] + count)
+        self._positions = positions = array('l', [0]) * len(keys)
+        fill = offsets[:-1]
+        for i, slot in enumerate(pair_slots):
+            positions[fill[slot]] = i
+            fill[slot] += 1
+    
+    def _flatten(self):
+        keys = [None] * len(self._slots)
+        for key, slot in self._slots.iteritems():
+            keys[slot] = key
+        return keys, self._offsets, self._positions, self._values
+    
+    def _set_flat(self, keys, offsets, positions, values):
+        self._slots = dict((key, slot) for slot, key in enumerate(keys))
+        self._offsets = offsets
+        self._positions = positions
+        self._values = values
+        self._keys = key_of = [None] * len(values)
+        for slot, key in enumerate(keys):
+            for i in positions[offsets[slot]:offsets[slot + 1]]:
+                key_of[i] = key
+    
+    def _ids(self, key):
+        """The positions of the given (conformed) key."""
+        slot = self._slots.get(key)
+        if slot is None:
+            return ()
+        return self._positions[self._offsets[slot]:self._offsets[slot + 1]]
+    
+    @property
+    def _pairs(self):
+        return zip(self._keys, self._values)
+    
+    @property
+    def _key_ids(self):
+        return dict((key, self._ids(key).tolist()) for key in self._slots)
+    
+    def _key_counts(self):
+        offsets = self._offsets
+        return dict((key, offsets[slot + 1] - offsets[slot])
+            for key, slot in self._slots.iteritems())
+    
+    def __getitem__(self, key):
+        key = self._conform_key(key)
+        try:
+            slot = self._slots[key]
+        except KeyError:
+            raise KeyError(key)
+        return self._values[self._positions[self._offsets[slot]]]
+    
+    def __contains__(self, key):
+        return self._conform_key(key) in self._slots
+    
+    def __len__(self):
+        return len(self._slots)
+    
+    def __nonzero__(self):
+        return bool(self._values)
+    
+    def alllen(self):
+        return len(self._values)
+    
+    def getall(self, key):
+        values = self._values
+        return [values[i] for i in self._ids(self._conform_key(key))]
+    
+    getlist = list = getall
+    
+    def iteritems(self):
+        # The first position of every slot, in order.
+        positions = self._positions
+        keys = self._keys
+        values = self._values
+        for i in sorted(positions[x] for x in self._offsets[:-1]):
+            yield keys[i], values[i]
+    
+    def iterallitems(self):
+        return izip(self._keys, self._values)
+    
+    def allitems(self):
+        return zip(self._keys, self._values)
+    
+    def allkeys(self):
+        return self._keys[:]
+    
+    def allvalues(self):
+        return self._values[:]
+    
+    def iteritemlists(self):
+        values = self._values
+        for key, value in self.iteritems():
+            yield key, [values[i] for i in self._ids(key)]
+    
+    def _positions_of(self, key):
+        return self._ids(key)
+    
+    def _pair_at(self, index):
+        return self._keys[index], self._values[index]
+    
+    def _pair_slice(self, index):
+        return zip(self._keys[index], self._values[index])
+
+
+class FrozenMultiMap(MultiMap):
+    """An immutable, hashable MultiMap.
+    
+    The pairs and the key index are stored as tuples, built once. As with
+    any MultiMap, two are equal only if they have the same pairs in the same
+    order, and equal frozen maps hash the same way.
+    
+    >>> f = FrozenMultiMap([('a', 1), ('b', 2), ('a', 3)])
+    >>> f.copy() is f
+    True
+    >>> g = FrozenMultiMap([('a', 1), ('b', 2), ('a', 3)])
+    >>> f == g, hash(f) == hash(g)
+    (True, True)
+    >>> f == FrozenMultiMap([('a', 1), ('b', 2)])
+    False
+    >>> cache = {f: 'cached'}
+    >>> cache[g]
+    'cached'
+    
+    """
+    
+    _hash = None
+    
+    # What thaw returns. As with MutableMultiMap._frozen_class, subclasses
+    # which override the conform methods thaw to a matching subclass of
+    # MutableMultiMap if it is not set.
+    _thawed_class = None
+    
+    def _rebuild_key_ids(self):
+        MultiMap._rebuild_key_ids(self)
+        self._pairs = tuple(self._pairs)
+        key_ids = self._key_ids
+        for key, ids in key_ids.iteritems():
+            key_ids[key] = tuple(ids)
+    
+    def _set_flat(self, keys, offsets, positions, values):
+        MultiMap._set_flat(self, keys, offsets, positions, values)
+        self._pairs = tuple(self._pairs)
+        key_ids = self._key_ids
+        for key, ids in key_ids.iteritems():
+            key_ids[key] = tuple(ids)
+    
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(tuple(self._pairs))
+        return self._hash
+    
+    def copy(self):
+        return self
+    
+    def thaw(self):
+        """Get a MutableMultiMap with the same pairs.
+        
+        The new map shares this one's storage until it is first changed, so
+        thawing is O(1). As with MutableMultiMap.freeze, it gets the same
+        public attributes instead of going through __init__.
+        
+        >>> f = FrozenMultiMap([('a', 1), ('b', 2)])
+        >>> m = f.thaw()
+        >>> m['c'] = 3
+        >>> m
+        MutableMultiMap([('a', 1), ('b', 2), ('c', 3)])
+        >>> f
+        FrozenMultiMap([('a', 1), ('b', 2)])
+        
+        """
+        cls = self._thawed_class or _conforming_class(self.__class__,
+            MutableMultiMap, 'Thawed')
+        thawed = cls.__new__(cls)
+        thawed.__dict__.update(self._public_state())
+        thawed._pairs = self._pairs
+        thawed._key_ids = self._key_ids
+        thawed._shared = True
+        return thawed
+
+
+class MappedMultiMap(MultiMap):
+    """A read-only MultiMap over a file written by MappedMultiMap.write.
+    
+    The file is mmapped, so nothing is read until it is asked for, and every
+    process which maps the same file shares the same pages. Lookups go through
+    a hash table stored in the file, and only decode the pairs they return.
+    
+    Keys and values are stored with marshal, so they must be simple builtin
+    types, and keys are matched by their marshalled form (1 and 1.0 are
+    different keys). Anything that needs _pairs or _key_ids directly will load
+    them entirely.
+    
+    The file has a header, then these tables, then the marshalled data:
+    
+        pairs   -- (slot of the key, offset of the value) for every pair
+        keys    -- (offset of the key, start in ids, count) for every slot
+        buckets -- slot + 1 (or 0 if empty) for an open addressing hash table
+        ids     -- the positions of every key, grouped by slot
+    
+    >>> import os, tempfile
+    >>> fd, path = tempfile.mkstemp()
+    >>> MappedMultiMap.write(path, [('a', 1), ('b', 2), ('a', 3), ('c', 4)])
+    >>> m = MappedMultiMap(path)
+    >>> m['a'], m.getall('a'), m.get('x'), 'c' in m
+    (1, [1, 3], None, True)
+    >>> m.keys(), len(m), m.alllen()
+    (['a', 'b', 'c'], 3, 4)
+    >>> m
+    MappedMultiMap([('a', 1), ('b', 2), ('a', 3), ('c', 4)])
+    >>> m.close()
+    >>> os.close(fd); os.unlink(path)
+    
+    """
+    
+    _MAGIC = 'MMF1'
+    
+    # magic, number of pairs, number of keys, number of buckets
+    _header = struct.Struct('<4sQQQ')
+    _pair = struct.Struct('<QQ')
+    _key = struct.Struct('<QQQ')
+    _bucket = struct.Struct('<Q')
+    _id = struct.Struct('<Q')
+    _size = struct.Struct('<I')
+    
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._pair_count, self._key_count, self._bucket_count = \
+            self._header.unpack_from(self._map)
+        if magic != self._MAGIC:
+            raise ValueError('%r is not a MappedMultiMap file' % path)
+        self._pairs_start = self._header.size
+        self._keys_start = self._pairs_start + self._pair_count * self._pair.size
+        self._buckets_start = self._keys_start + self._key_count * self._key.size
+        self._ids_start = self._buckets_start + self._bucket_count * self._bucket.size
+        self._data_start = self._ids_start + self._pair_count * self._id.size
+    
+    @classmethod
+    def write(cls, path, pairs):
+        """Write the given pairs to a file which can be opened by this class.
+        
+        The pairs are conformed just as they would be by the constructor of
+        the class this is called on.
+        
+        """
+        conform = cls.__new__(cls)._conform_pair
+        data = []
+        data_size = [0]
+        def add_data(obj):
+            blob = marshal.dumps(obj)
+            offset = data_size[0]
+            data.append(cls._size.pack(len(blob)))
+            data.append(blob)
+            data_size[0] += cls._size.size + len(blob)
+            return offset, blob
+        
+        pair_slots = []
+        value_offsets = []
+        slots = {}
+        keys = []
+        for pair in pairs:
+            key, value = conform(pair)
+            key_blob = marshal.dumps(key)
+            slot = slots.get(key_blob)
+            if slot is None:
+                slot = slots[key_blob] = len(keys)
+                keys.append([add_data(key)[0], crc32(key_blob), []])
+            keys[slot][2].append(len(pair_slots))
+            pair_slots.append(slot)
+            value_offsets.append(add_data(value)[0])
+        
+        bucket_count = 8
+        while bucket_count < 2 * len(keys):
+            bucket_count *= 2
+        buckets = [0] * bucket_count
+        for slot, (offset, hash, ids) in enumerate(keys):
+            i = hash & (bucket_count - 1)
+            while buckets[i]:
+                i = (i + 1) & (bucket_count - 1)
+            buckets[i] = slot + 1
+        
+        with open(path, 'wb') as fh:
+            fh.write(cls._header.pack(cls._MAGIC, len(pair_slots), len(keys),
+                bucket_count))
+            for slot, offset in izip(pair_slots, value_offsets):
+                fh.write(cls._pair.pack(slot, offset))
+            start = 0
+            for offset, hash, ids in keys:
+                fh.write(cls._key.pack(offset, start, len(ids)))
+                start += len(ids)
+            for bucket in buckets:
+                fh.write(cls._bucket.pack(bucket))
+            for offset, hash, ids in keys:
+                fh.write(struct.pack('<%dQ' % len(ids), *ids))
+            fh.writelines(data)
+    
+    def close(self):
+        self._map.close()
+    
+    def __reduce__(self):
+        # Other processes should map the file for themselves.
+        return self.__class__, (self.path, )
+    
+    def _read(self, offset):
+        """Unmarshal the object at the given offset into the data."""
+        offset += self._data_start
+        size, = self._size.unpack_from(self._map, offset)
+        offset += self._size.size
+        return marshal.loads(self._map[offset:offset + size])
+    
+    def _read_pair(self, i):
+        slot, value_offset = self._pair.unpack_from(self._map,
+            self._pairs_start + i * self._pair.size)
+        return self._read(self._slot(slot)[0]), self._read(value_offset)
+    
+    def _slot(self, slot):
+        return self._key.unpack_from(self._map,
+            self._keys_start + slot * self._key.size)
+    
+    def _find(self, key):
+        """Get (key offset, start, count) for the given (conformed) key, or
+        None if it is not in the file.
+        
+        """
+        blob = marshal.dumps(key)
+        mask = self._bucket_count - 1
+        i = crc32(blob) & mask
+        while True:
+            bucket, = self._bucket.unpack_from(self._map,
+                self._buckets_start + i * self._bucket.size)
+            if not bucket:
+                return None
+            info = self._slot(bucket - 1)
+            offset = self._data_start + info[0]
+            size, = self._size.unpack_from(self._map, offset)
+            offset += self._size.size
+            if self._map[offset:offset + size] == blob:
+                return info
+            i = (i + 1) & mask
+    
+    def _ids(self, info):
+        key_offset, start, count = info
+        return struct.unpack_from('<%dQ' % count, self._map,
+            self._ids_start + start * self._id.size)
+    
+    @property
+    def _pairs(self):
+        return self.allitems()
+    
+    def _key_counts(self):
+        return None
+    
+    @property
+    def _key_ids(self):
+        key_ids = {}
+        for slot in xrange(self._key_count):
+            info = self._slot(slot)
+            key_ids[self._read(info[0])] = list(self._ids(info))
+        return key_ids
+    
+    def __getitem__(self, key):
+        key = self._conform_key(key)
+        info = self._find(key)
+        if info is None:
+            raise KeyError(key)
+        first, = self._id.unpack_from(self._map,
+            self._ids_start + info[1] * self._id.size)
+        return self._read_pair(first)[1]
+    
+    def __contains__(self, key):
+        return self._find(self._conform_key(key)) is not None
+    
+    def __len__(self):
+        return self._key_count
+    
+    def __nonzero__(self):
+        return bool(self._pair_count)
+    
+    def alllen(self):
+        return self._pair_count
+    
+    def getall(self, key):
+        info = self._find(self._conform_key(key))
+        if info is None:
+            return []
+        return [self._read_pair(i)[1] for i in self._ids(info)]
+    
+    getlist = list = getall
+    
+    def iteritems(self):
+        for i in xrange(self._pair_count):
+            slot, value_offset = self._pair.unpack_from(self._map,
+                self._pairs_start + i * self._pair.size)
+            key_offset, start, count = self._slot(slot)
+            first, = self._id.unpack_from(self._map,
+                self._ids_start + start * self._id.size)
+            if first == i:
+                yield self._read(key_offset), self._read(value_offset)
+    
+    def iterallitems(self):
+        for i in xrange(self._pair_count):
+            yield self._read_pair(i)
+    
+    def allitems(self):
+        return list(self.iterallitems())
+    
+    # Slices of the pairs view are read into memory.
+    _slice_class = MultiMap
+    
+    def _positions_of(self, key):
+        info = self._find(key)
+        return () if info is None else self._ids(info)
+    
+    def _pair_at(self, index):
+        if index < 0:
+            index += self._pair_count
+        if not 0 <= index < self._pair_count:
+            raise IndexError('index out of range')
+        return self._read_pair(index)
+    
+    def _pair_slice(self, index):
+        return [self._read_pair(i) for i in xrange(*index.indices(self._pair_count))]
+
+
+class DelayedTraits(object):
+    """Fill the mapping from a supplier only as it is needed.
+    
+    The supplier is called on first use, and the pairs of the iterable it
+    returns are read one at a time. Lookups and iteration stop reading as soon
+    as they have what they need. Everything else (len, getall, missing keys,
+    and any change to the mapping) reads the rest of it first.
+    
+    """
+    
+    def __init__(self, supplier=None):
+        self.supplier = supplier
+        self.__pairs = None
+        self.__key_ids = None
+        
+        # The iterator we are reading pairs from, while there are still more.
+        self.__source = None
+    
+    def _pull(self):
+        """Read the next pair from the supplier into the mapping.
+        
+        Returns False once there are no more.
+        
+        """
+        if self.__pairs is None:
+            self.__pairs = []
+            self.__key_ids = {}
+            self.__source = iter(self.supplier())
+        if self.__source is None:
+            return False
+        for key, value in self.__source:
+            key = self._conform_key(key)
+            try:
+                self.__key_ids[key].append(len(self.__pairs))
+            except KeyError:
+                self.__key_ids[key] = [len(self.__pairs)]
+            self.__pairs.append((key, self._conform_value(value)))
+            return True
+        self.__source = None
+        return False
+    
+    def _drain(self):
+        """Read everything left in the supplier; returns how many pairs."""
+        count = 0
+        while self._pull():
+            count += 1
+        return count
+    
+    @property
+    def _pairs(self):
+        if self.__source is not None or self.__pairs is None:
+            self._drain()
+        return self.__pairs
+    
+    @_pairs.setter
+    def _pairs(self, value):
+        self.__pairs = value
+        self.__source = None
+    
+    @property
+    def _key_ids(self):
+        if self.__source is not None or self.__pairs is None:
+            self._drain()
+        return self.__key_ids
+    
+    @_key_ids.setter
+    def _key_ids(self, value):
+        self.__key_ids = value
+    
+    def _public_state(self):
+        # Everything will have been read from the supplier by now, and it is
+        # often something which can't be pickled.
+        state = super(DelayedTraits, self)._public_state()
+        state.pop('supplier', None)
+        return state
+    
+    def _first_id(self, key):
+        """The position of the first pair with the given (conformed) key.
+        
+        Only reads as far as the first such pair. Raises a KeyError if there
+        are none.
+        
+        """
+        if self.__pairs is None:
+            self._pull()
+        while True:
+            ids = self.__key_ids.get(key)
+            if ids:
+                return ids[0]
+            if not self._pull():
+                raise KeyError(key)
+    
+    def __getitem__(self, key):
+        id = self._first_id(self._conform_key(key))
+        return self.__pairs[id][1]
+    
+    def __contains__(self, key):
+        try:
+            self._first_id(self._conform_key(key))
+        except KeyError:
+            return False
+        return True
+    
+    def __nonzero__(self):
+        if not self.__pairs:
+            self._pull()
+        return len(self.__pairs) > self._dead
+    
+    def iteritems(self):
+        # The first position of a key is known as soon as its first pair has
+        # been read, so this can go along with iterallitems. That stops
+        # lining up with the positions once pairs are removed, though.
+        if self._dead:
+            for pair in super(DelayedTraits, self).iteritems():
+                yield pair
+            return
+        for i, pair in enumerate(self.iterallitems()):
+            if self.__key_ids[pair[0]][0] == i:
+                yield pair
+    
+    def iterallitems(self):
+        # Once everything is read the pairs may have tombstones in them, so
+        # leave it to the normal implementation.
+        i = 0
+        while self.__source is not None or self.__pairs is None:
+            if i < len(self.__pairs or ()):
+                yield self.__pairs[i]
+                i += 1
+            elif not self._pull():
+                break
+        if i == 0:
+            for pair in super(DelayedTraits, self).iterallitems():
+                yield pair
+        else:
+            for pair in self.__pairs[i:]:
+                yield pair
+
+
+class DelayedMultiMap(DelayedTraits, MultiMap):
+    """
+    >>> def gen():
+    ...     print 'generating'
+    ...     for x in range(5):
+    ...         yield (x, 'x')
+    >>> m = DelayedMultiMap(gen)
+    >>> m[0]
+    generating
+    'x'
+    >>> m[5] = 'new'
+    Traceback (most recent call last):
+    ...
+    TypeError: 'DelayedMultiMap' object does not support item assignment
+    
+    Only as much of the supplier is read as is needed.
+    
+    >>> def gen():
+    ...     for x in 'abcabc':
+    ...         print 'yielding', x
+    ...         yield (x, x.upper())
+    >>> m = DelayedMultiMap(gen)
+    >>> m['b']
+    yielding a
+    yielding b
+    'B'
+    >>> 'a' in m
+    True
+    >>> for key in m:
+    ...     if key == 'c':
+    ...         break
+    yielding c
+    >>> m.getall('a')
+    yielding a
+    yielding b
+    yielding c
+    ['A', 'A']
+    
+    """
+    
+    pass
+
+class DelayedMutableMultiMap(DelayedTraits, MutableMultiMap):
+    """
+    >>> def gen():
+    ...     print 'generating'
+    ...     for x in range(5):
+    ...         yield (x, 'x')
+    >>> m = DelayedMutableMultiMap(gen)
+    >>> m[0]
+    generating
+    'x'
+    >>> m[5] = 'new'
+    >>> m
+    DelayedMutableMultiMap([(0, 'x'), (1, 'x'), (2, 'x'), (3, 'x'), (4, 'x'), (5, 'new')])
+    
+    """
+    
+    def copy(self):
+        # The copy can't share our place in the supplier.
+        self._drain()
+        return MutableMultiMap.copy(self)
+
+
+class _SortedKeyDict(dict):
+    """A dict which also keeps a sorted list of its keys.
+    
+    Only the methods which the maps use to add and remove keys of _key_ids
+    keep the list up to date.
+    
+    """
+    
+    __slots__ = ('sorted_keys', )
+    
+    def __init__(self, other=(), sorted_keys=None):
+        dict.__init__(self, other)
+        self.sorted_keys = sorted(self) if sorted_keys is None else list(sorted_keys)
+    
+    def _discard(self, key):
+        keys = self.sorted_keys
+        del keys[bisect_left(keys, key)]
+    
+    def __setitem__(self, key, value):
+        if key not in self:
+            insort(self.sorted_keys, key)
+        dict.__setitem__(self, key, value)
+    
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._discard(key)
+    
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        self._discard(key)
+        return dict.pop(self, key)
+    
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._discard(key)
+        return key, value
+    
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+    
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+    
+    def clear(self):
+        dict.clear(self)
+        del self.sorted_keys[:]
+
+
+class SortedKeysTraits(object):
+    """Keep the keys in a sorted index as well, for range queries.
+    
+    The order of the pairs is left alone; the index is only of the keys, and
+    is kept up to date as keys come and go (a new key costs a bisect and a
+    list insert). The keys must all be comparable with each other. None as a
+    bound in the range methods means that end is open.
+    
+    >>> m = SortedKeysMutableMultiMap([(30, 'c'), (10, 'a'), (20, 'b'), (10, 'd')])
+    >>> m.minkey(), m.maxkey(), m.sortedkeys()
+    (10, 30, [10, 20, 30])
+    >>> list(m.irange(15, 30)), list(m.irange(hi=20, inclusive=(True, False)))
+    ([20, 30], [10])
+    >>> list(m.irangeallitems(10, 20))
+    [(10, 'a'), (10, 'd'), (20, 'b')]
+    >>> m.append((15, 'e'))
+    >>> del m[30]
+    >>> m.sortedkeys(), m.bisect_key(16)
+    ([10, 15, 20], 2)
+    >>> m
+    SortedKeysMutableMultiMap([(10, 'a'), (20, 'b'), (10, 'd'), (15, 'e')])
+    
+    """
+    
+    def _rebuild_key_ids(self):
+        super(SortedKeysTraits, self)._rebuild_key_ids()
+        self._key_ids = _SortedKeyDict(self._key_ids)
+    
+    def _set_flat(self, keys, offsets, positions, values):
+        super(SortedKeysTraits, self)._set_flat(keys, offsets, positions, values)
+        self._key_ids = _SortedKeyDict(self._key_ids)
+    
+    def _unshare(self):
+        sorted_keys = getattr(self._key_ids, 'sorted_keys', None)
+        super(SortedKeysTraits, self)._unshare()
+        self._key_ids = _SortedKeyDict(self._key_ids, sorted_keys)
+    
+    def sortedkeys(self):
+        """A list of the keys, in sorted order."""
+        return list(self._key_ids.sorted_keys)
+    
+    def minkey(self):
+        """The smallest key; raises KeyError if there are none."""
+        try:
+            return self._key_ids.sorted_keys[0]
+        except IndexError:
+            raise KeyError('minkey(): %s is empty' % self.__class__.__name__)
+    
+    def maxkey(self):
+        """The largest key; raises KeyError if there are none."""
+        try:
+            return self._key_ids.sorted_keys[-1]
+        except IndexError:
+            raise KeyError('maxkey(): %s is empty' % self.__class__.__name__)
+    
+    def bisect_key(self, key):
+        """Where the key is (or would be) in sortedkeys(), like bisect_left."""
+        return bisect_left(self._key_ids.sorted_keys, self._conform_key(key))
+    
+    def irange(self, lo=None, hi=None, inclusive=(True, True)):
+        """Iterate over the keys from lo to hi, in sorted order."""
+        keys = self._key_ids.sorted_keys
+        if lo is None:
+            start = 0
+        else:
+            bisect = bisect_left if inclusive[0] else bisect_right
+            start = bisect(keys, self._conform_key(lo))
+        if hi is None:
+            stop = len(keys)
+        else:
+            bisect = bisect_right if inclusive[1] else bisect_left
+            stop = bisect(keys, self._conform_key(hi))
+        # Slice so that changing the map while iterating is safe.
+        return iter(keys[start:stop])
+    
+    def irangeallitems(self, lo=None, hi=None, inclusive=(True, True)):
+        """Iterate over all pairs with keys from lo to hi, in sorted order of
+        keys, and in their own order within a key.
+        
+        """
+        for key in self.irange(lo, hi, inclusive):
+            for i in self._key_ids.get(key, ()):
+                yield self._pairs[i]
+
+
+class SortedKeysMultiMap(SortedKeysTraits, MultiMap):
+    pass
+
+
+class SortedKeysMutableMultiMap(SortedKeysTraits, MutableMultiMap):
+    pass
+
+
+class JournalOverflow(ValueError):
+    """The changes asked for have already been pushed out of the journal.
+    
+    Whoever asked has to start over from a copy of the whole map.
+    
+    """
+
+
+def _copy_items(mapping):
+    if isinstance(mapping, collections.Mapping):
+        mapping = mapping.items()
+    return [(key, list(values)) for key, values in mapping]
+
+
+# The changes which JournalTraits records, with the argument of each (if any)
+# which may be an iterable, and how to copy it to keep in the record. The
+# rest of the mutating methods are built on these ones.
+_JOURNALED = (
+    ('__setitem__', None, None),
+    ('__delitem__', None, None),
+    ('clear', None, None),
+    ('setall', 1, list),
+    ('setall_many', 0, _copy_items),
+    ('delete_many', 0, list),
+    ('remove', None, None),
+    ('insert', None, None),
+    ('insert_many', 0, list),
+    ('append', None, None),
+    ('extend', 0, list),
+    ('apply_delta', 0, list),
+    ('popone', None, None),
+    ('popitem', None, None),
+    ('sort', None, None),
+    ('sort_keys', None, None),
+    ('reverse', None, None),
+)
+
+
+def _journaled(name, index, copy):
+    def change(self, *args, **kwargs):
+        method = getattr(super(JournalTraits, self), name)
+        if self._journaling:
+            # Part of a change which is already being recorded.
+            return method(*args, **kwargs)
+        if index is not None and len(args) > index:
+            args = list(args)
+            args[index] = copy(args[index])
+            args = tuple(args)
+        version = self._version
+        self._journaling = True
+        try:
+            result = method(*args, **kwargs)
+        finally:
+            self._journaling = False
+        if self._version != version:
+            self._record(name, args, kwargs)
+        return result
+    change.__name__ = name
+    change.__doc__ = 'MutableMultiMap.%s, recorded in the journal.' % name
+    return change
+
+
+class JournalTraits(object):
+    """Keep a journal of the latest changes to the mapping.
+    
+    Every change is recorded as a (version, name, args, kwargs) tuple, where
+    version counts the changes up from 0 and the rest is the method call
+    which made it (an outer one, so pop(key) is recorded as the __delitem__
+    it does). Iterables given as arguments are recorded as lists. Calls which
+    turned out not to change anything, such as popone of a missing key with a
+    default, are not recorded.
+    
+    Only the last journal_size changes are kept. Someone keeping a copy of
+    the map up to date asks for the changes_since the version they last saw,
+    and makes the same calls on their copy; a JournalOverflow means they fell
+    too far behind, and have to copy the map again.
+    
+    >>> m = JournaledMutableMultiMap([('a', 1)])
+    >>> replica = MutableMultiMap(m.allitems())
+    >>> seen = m.journal_version
+    >>> m.append(('b', 2))
+    >>> m.popone('a'), m.popone('a', None)
+    (1, None)
+    >>> m.setall('b', iter([3, 4]))
+    >>> for change in m.changes_since(seen):
+    ...     print change
+    ...     version, name, args, kwargs = change
+    ...     result = getattr(replica, name)(*args, **kwargs)
+    (1, 'append', (('b', 2),), {})
+    (2, 'popone', ('a',), {})
+    (3, 'setall', ('b', [3, 4]), {})
+    >>> replica == m
+    True
+    
+    """
+    
+    # How many of the latest changes are kept. It may be changed at any time;
+    # the journal is trimmed (or given room) by the next change.
+    journal_size = 1024
+    
+    # The version of the mapping as of the latest change.
+    journal_version = 0
+    
+    # The ring of recorded changes; it is created by the first of them, and
+    # made again whenever journal_size has changed since.
+    _journal = None
+    
+    # Set while a change is being made, so that calls it makes to other
+    # methods are not recorded too.
+    _journaling = False
+    
+    def _record(self, name, args, kwargs):
+        journal = self._journal
+        if journal is None or journal.maxlen != self.journal_size:
+            self._journal = collections.deque(journal or (),
+                maxlen=self.journal_size)
+        self.journal_version += 1
+        self._journal.append((self.journal_version, name, args, kwargs))
+    
+    def changes_since(self, version):
+        """An iterator of the changes made after the given version.
+        
+        Raises a JournalOverflow if any of them are no longer kept.
+        
+        >>> m = JournaledMutableMultiMap()
+        >>> m.journal_size = 2
+        >>> for i in range(3):
+        ...     m.append(('a', i))
+        >>> [change[0] for change in m.changes_since(1)]
+        [2, 3]
+        >>> m.changes_since(0)
+        Traceback (most recent call last):
+        ...
+        JournalOverflow: changes since version 0 are no longer kept; the oldest is 2
+        
+        """
+        journal = self._journal or ()
+        missing = self.journal_version - version
+        if missing < 0:
+            raise ValueError('version %d is newer than %d' % (version,
+                self.journal_version))
+        if missing > len(journal):
+            raise JournalOverflow('changes since version %d are no longer '
+                'kept; the oldest is %d' % (version,
+                self.journal_version - len(journal) + 1))
+        return iter(list(islice(journal, len(journal) - missing,
+            None)))
+    
+    def copy(self):
+        # The copy starts its own journal, from the same version.
+        copy = super(JournalTraits, self).copy()
+        copy._journal = None
+        copy.journal_version = self.journal_version
+        return copy
+    
+    for _name, _index, _copy in _JOURNALED:
+        locals()[_name] = _journaled(_name, _index, _copy)
+    del _name, _index, _copy
+
+
+class JournaledMutableMultiMap(JournalTraits, MutableMultiMap):
+    pass
+
+
+class JournaledLinkedMutableMultiMap(JournalTraits, LinkedMutableMultiMap):
+    pass
+
+
+def _optimistic_reader(name):
+    def read(self, *args):
+        # A write may be in progress, or start while we read; if so, what we
+        # read may be wrong (or may raise) and we read again under the lock.
+        seq = self._seq
+        if not seq & 1:
+            try:
+                result = getattr(self._map, name)(*args)
+            except Exception:
+                if self._seq == seq:
+                    raise
+            else:
+                if self._seq == seq:
+                    return result
+        with self._lock:
+            return getattr(self._map, name)(*args)
+    read.__name__ = name
+    read.__doc__ = 'MutableMultiMap.%s, read without taking the lock.' % name
+    return read
+
+
+def _locked_reader(name):
+    def read(self, *args):
+        # These may change the storage, so they count as writes.
+        with self._lock:
+            self._seq += 1
+            try:
+                return getattr(self._map, name)(*args)
+            finally:
+                self._seq += 1
+    read.__name__ = name
+    read.__doc__ = 'MutableMultiMap.%s, with the lock held.' % name
+    return read
+
+
+def _snapshot_reader(name):
+    def read(self, *args):
+        return getattr(self.snapshot(), name)(*args)
+    read.__name__ = name
+    read.__doc__ = 'FrozenMultiMap.%s, of the current snapshot.' % name
+    return read
+
+
+def _locked_writer(name, index=None, copy=None):
+    def write(self, *args, **kwargs):
+        # Read iterables before taking the lock, as they may be this map, or
+        # another one which is waiting on this one. Lists and tuples can't be.
+        if index is not None and len(args) > index and not (
+            copy is list and type(args[index]) in (list, tuple)):
+            args = list(args)
+            args[index] = copy(args[index])
+        with self._lock:
+            self._seq += 1
+            try:
+                return getattr(self._map, name)(*args, **kwargs)
+            finally:
+                self._seq += 1
+    write.__name__ = name
+    write.__doc__ = 'MutableMultiMap.%s, with the lock held.' % name
+    return write
+
+
+def _copy_mapping(mapping):
+    return collections.OrderedDict((key, mapping[key]) for key in mapping)
+
+
+class ConcurrentMultiMap(collections.MutableMapping):
+    """A MutableMultiMap which can be shared between threads.
+    
+    Writers take a lock, so every change is atomic, including the compound
+    ones such as setall, popone, pop and setdefault. Use transaction() for
+    several changes which readers must see all at once.
+    
+    Readers don't take the lock at all. Writers count a sequence number up
+    before and after every change, and a read is only kept if the number was
+    even and is still the same once it is done; otherwise the read is made
+    again under the lock. So readers never wait for each other, and only wait
+    for a writer if they overlapped with it. The reads which fill in caches on
+    the map (index, keysfor, containsvalue, grouped and to_bytes) always take
+    the lock, and count as writes.
+    
+    Iterators are never left holding the lock: the iter* methods iterate over
+    a list, and the views and the pairs view are of a snapshot. snapshot()
+    gives the current contents as a FrozenMultiMap, for any number of reads
+    which must agree; it is cached until the next change, but the first
+    change after it has to copy the storage (see MutableMultiMap.copy).
+    
+    Nothing given to a method may call back into the same map (e.g. a sort
+    key), as the lock cannot be taken again by the thread which holds it.
+    Iterables given to writers are read before the lock is taken.
+    
+    >>> m = ConcurrentMultiMap([('a', 1), ('b', 2)])
+    >>> m.append(('a', 3))
+    >>> m.getall('a'), m.popone('a'), m['a']
+    ([1, 3], 1, 3)
+    >>> snap = m.snapshot()
+    >>> with m.transaction() as writable:
+    ...     writable['c'] = 4
+    ...     del writable['b']
+    >>> m.extend((key, value * 10) for key, value in m.iteritems())
+    >>> m
+    ConcurrentMultiMap([('a', 3), ('c', 4), ('a', 30), ('c', 40)])
+    >>> snap
+    FrozenMultiMap([('b', 2), ('a', 3)])
+    
+    """
+    
+    # The class of the map underneath; it decides how keys and values are
+    # conformed.
+    _map_class = MutableMultiMap
+    
+    def __init__(self, *args, **kwargs):
+        self._init(self._map_class(*args, **kwargs))
+    
+    def _init(self, map):
+        # A plain lock is much cheaper than an RLock, which is written in
+        # Python; nothing here needs to reenter it.
+        self._lock = threading.Lock()
+        self._map = map
+        self._frozen = None
+        # Odd while a change is being made; see _optimistic_reader.
+        self._seq = 0
+    
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._lock:
+            self._seq += 1
+            try:
+                yield
+            finally:
+                self._seq += 1
+    
+    def snapshot(self):
+        """The current contents, as a FrozenMultiMap.
+        
+        It conforms keys and values as the map does.
+        
+        """
+        # Freezing may compact the map, so readers must not see it happen.
+        with self._writing():
+            version = self._map._version
+            frozen = self._frozen
+            if frozen is None or frozen[0] != version:
+                frozen = self._frozen = (version, self._map.freeze())
+            return frozen[1]
+    
+    freeze = snapshot
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """Hold the lock, and give the underlying map to change.
+        
+        Nobody sees any of the changes until the block is done. Change the
+        map which is given; calling methods of this one would deadlock.
+        
+        """
+        with self._writing():
+            yield self._map
+    
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.allitems())
+    
+    def __reduce__(self):
+        return self.__class__, (self.allitems(), )
+    
+    def __eq__(self, other):
+        if isinstance(other, ConcurrentMultiMap):
+            other = other.snapshot()
+        return self.snapshot() == other
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def copy(self):
+        with self._lock:
+            map = self._map.copy()
+        copy = self.__class__.__new__(self.__class__)
+        copy._init(map)
+        return copy
+    
+    @property
+    def pairs(self):
+        """A PairsView of the current snapshot."""
+        return self.snapshot().pairs
+    
+    for _name in ('__getitem__', '__contains__', '__len__', '__nonzero__',
+        'has_key', 'get', 'getall', 'getlist', 'count', 'alllen', 'keys',
+        'values', 'items', 'allkeys', 'allvalues', 'allitems', 'itemlists',
+        'lists'):
+        locals()[_name] = _optimistic_reader(_name)
+    
+    for _name in ('index', 'keysfor', 'containsvalue', 'grouped', 'to_bytes'):
+        locals()[_name] = _locked_reader(_name)
+    
+    # diff may well be given this same map, which would deadlock on the lock.
+    for _name in ('viewkeys', 'viewvalues', 'viewitems', 'diff'):
+        locals()[_name] = _snapshot_reader(_name)
+    
+    for _name, _index, _copy in _JOURNALED + (('update', 0, _copy_mapping), ):
+        locals()[_name] = _locked_writer(_name, _index, _copy)
+    
+    for _name in ('discard', 'pop', 'popall', 'setdefault', 'index_values'):
+        locals()[_name] = _locked_writer(_name)
+    
+    del _name, _index, _copy
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    iterkeys = __iter__
+    
+    def itervalues(self):
+        return iter(self.values())
+    
+    def iteritems(self):
+        return iter(self.items())
+    
+    def iterallkeys(self):
+        return iter(self.allkeys())
+    
+    def iterallvalues(self):
+        return iter(self.allvalues())
+    
+    def iterallitems(self):
+        return iter(self.allitems())
+    
+    def iteritemlists(self):
+        return iter(self.itemlists())
+    
+    def iterlists(self):
+        return iter(self.lists())
+
+
+class OperationStats(object):
+    """Counters for one internal operation, kept by an Instrumentation.
+    
+    Time is inclusive, so an operation which calls another (e.g. _drain calls
+    _pull) is counted in both.
+    
+    """
+    
+    __slots__ = ('calls', 'pairs', 'seconds')
+    
+    def __init__(self):
+        self.calls = 0
+        self.pairs = 0
+        self.seconds = 0.0
+    
+    def __repr__(self):
+        return '<%s calls=%d pairs=%d seconds=%.6f>' % (self.__class__.__name__,
+            self.calls, self.pairs, self.seconds)
+    
+    def as_dict(self):
+        return dict(calls=self.calls, pairs=self.pairs, seconds=self.seconds)
+
+
+def _count_arg(self, args, result):
+    return len(args[0])
+
+def _count_result(self, args, result):
+    return len(result)
+
+def _count_all(self, args, result):
+    return self.alllen()
+
+def _count_one(self, args, result):
+    return 1
+
+
+# The internal operations which are instrumented, and how to count the pairs
+# each call touched.
+_INSTRUMENTED = [
+    ('_set_pairs', _count_arg),
+    ('_rebuild_key_ids', _count_all),
+    ('_remove_pairs', _count_arg),
+    ('_insert_pairs', _count_arg),
+    ('_compact', _count_all),
+    ('_unshare', _count_all),
+    ('_conform_pairs', _count_result),
+    ('_conform_pair', _count_one),
+    ('_conform_key', _count_one),
+    ('_conform_value', _count_one),
+    ('_pull', lambda self, args, result: int(result)),
+    ('_drain', lambda self, args, result: result),
+]
+
+# These are only instrumented if they are overridden, so that the default
+# ones do not lose the fast path in _conform_pairs.
+_INSTRUMENTED_IF_OVERRIDDEN = set(['_conform_pair', '_conform_key',
+    '_conform_value'])
+
+
+class Instrumentation(object):
+    """A registry of OperationStats for instrumented maps.
+    
+    instrument(map) swaps the map onto a subclass of its own class which
+    wraps the internal operations (index rebuilds and fixups, compaction,
+    conforming, and reading delayed suppliers) to count calls, pairs touched
+    and time spent. Maps which are not instrumented are never touched, so
+    there is no cost at all until it is turned on. Stats are kept by the name
+    of the original class.
+    
+    The module-level instrumentation is the global registry, but a separate
+    one can be made for each part of an application that should be reported
+    on its own.
+    
+    >>> registry = Instrumentation()
+    >>> m = registry.instrument(MutableMultiMap([('a', 1), ('b', 2), ('a', 3)]))
+    >>> del m['a']
+    >>> m
+    MutableMultiMap([('b', 2)])
+    >>> registry.stats['MutableMultiMap', '_remove_pairs'].pairs
+    2
+    >>> sorted(registry.snapshot()['MutableMultiMap'])
+    ['_compact', '_remove_pairs']
+    >>> type(uninstrument(m)) is MutableMultiMap
+    True
+    
+    """
+    
+    def __init__(self):
+        # (class name, operation) -> OperationStats
+        self.stats = {}
+        self._classes = {}
+    
+    def snapshot(self):
+        """Get the stats of everything which has been called as nested
+        dicts, by class name then operation.
+        
+        """
+        out = {}
+        for (cls_name, operation), stats in self.stats.iteritems():
+            if stats.calls:
+                out.setdefault(cls_name, {})[operation] = stats.as_dict()
+        return out
+    
+    def reset(self):
+        for stats in self.stats.itervalues():
+            stats.__init__()
+    
+    def instrument(self, obj):
+        """Instrument a map in place (and return it), or get an instrumented
+        version of a class.
+        
+        """
+        if isinstance(obj, type):
+            return self._instrumented_class(obj)
+        obj.__class__ = self._instrumented_class(obj.__class__)
+        return obj
+    
+    def _instrumented_class(self, cls):
+        cls = getattr(cls, '_instrumented_base', cls)
+        try:
+            return self._classes[cls]
+        except KeyError:
+            pass
+        namespace = dict(
+            __slots__=(),
+            __module__=cls.__module__,
+            __doc__=cls.__doc__,
+            _instrumented_base=cls,
+            __reduce__=_instrumented_reduce,
+        )
+        for name, count in _INSTRUMENTED:
+            method = getattr(cls, name, None)
+            if method is None:
+                continue
+            if (name in _INSTRUMENTED_IF_OVERRIDDEN and
+                method.im_func is getattr(MultiMap, name).im_func):
+                continue
+            namespace[name] = self._wrap(cls.__name__, name, method, count)
+        instrumented = self._classes[cls] = type(cls.__name__, (cls, ), namespace)
+        return instrumented
+    
+    def _wrap(self, cls_name, name, method, count):
+        try:
+            stats = self.stats[cls_name, name]
+        except KeyError:
+            stats = self.stats[cls_name, name] = OperationStats()
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            start = _timer()
+            result = method(self, *args)
+            stats.seconds += _timer() - start
+            stats.calls += 1
+            stats.pairs += count(self, args, result)
+            return result
+        return wrapper
+
+
+def _instrumented_reduce(self):
+    # Pickle as the original class; the instrumentation does not travel.
+    cls = self.__class__
+    self.__class__ = cls._instrumented_base
+    try:
+        return self.__reduce__()
+    finally:
+        self.__class__ = cls
+
+
+instrumentation = Instrumentation()
+
+
+# The classes defined here, and the ABCs they are built on, which
+# _conforming_class does not copy from.
+_LIBRARY_CLASSES = frozenset(
+    [x for x in globals().values() if isinstance(x, type)] +
+    list(MutableMultiMap.__mro__) + list(ConcurrentMultiMap.__mro__))
+
+
+def instrument(obj, registry=None):
+    """Instrument a map (or class) against the global registry by default.
+    
+    See Instrumentation for details.
+    
+    """
+    return (registry or instrumentation).instrument(obj)
+
+
+def uninstrument(obj):
+    """Turn off instrumentation on a map in place, and return it."""
+    base = getattr(obj.__class__, '_instrumented_base', None)
+    if base is not None:
+        obj.__class__ = base
+    return obj
+
+
+def test_conform_methods():
+    class CaseInsensitive(MutableMultiMap):
+        def _conform_key(self, key):
+            return key.lower()
+    d = CaseInsensitive()
+    d['a'] = 1
+    d['A'] = 2
+    assert len(d) == 1
+    assert d['a'] == 2
+    d['Content-Encoding'] = 'deflate'
+    assert 'content-encoding' in d
+    assert 'blah' not in d
+
+
+def test_conform_cache():
+    class Prefixed(MutableMultiMap):
+        prefix = ''
+        @conform_cache(maxsize=2)
+        def _conform_key(self, key):
+            return self.prefix + str(key)
+    a = Prefixed()
+    b = Prefixed()
+    b.prefix = 'b:'
+    a['x'] = b['x'] = 1
+    assert a.keys() == ['x'] and b.keys() == ['b:x']
+    for key in ('x', 'y', 'z', 'x', 'x'):
+        a.get(key)
+    cache = Prefixed._conform_key.cache_of(a)
+    assert Prefixed._conform_key.cache is None
+    assert (cache.hits, cache.misses, len(cache)) == (2, 4, 2)
+    assert Prefixed._conform_key.cache_of(b).misses == 1
+    assert a.get(['unhashable']) is None
+    
+    class Lower(MutableMultiMap):
+        @conform_cache(pure=True)
+        def _conform_key(self, key):
+            return key.lower()
+    cache = Lower._conform_key.cache
+    assert Lower._conform_key.cache_of(Lower()) is cache
+    Lower(A=1)
+    cache.clear()
+    assert Lower._conform_key.cache_of(Lower()) is cache
+
+
+def test_compaction():
+    for threshold in (0, 0.5, 1):
+        m = MutableMultiMap([(i % 7, i) for i in range(100)])
+        m.compact_threshold = threshold
+        for key in (3, 0, 5):
+            del m[key]
+        m.popone(1)
+        m.setall(2, [-1])
+        assert threshold or not m._dead
+        expected = [(i % 7, i) for i in range(100) if i % 7 not in (0, 3, 5)]
+        expected.remove((1, 1))
+        expected = [x for x in expected if x[0] != 2 or x[1] == 2]
+        expected[expected.index((2, 2))] = (2, -1)
+        assert m.allitems() == expected
+        assert m.alllen() == len(expected)
+        assert m.getall(1) == [x[1] for x in expected if x[0] == 1]
+        m.insert(1, ('x', 'y'))
+        assert m.allitems()[1] == ('x', 'y')
+        assert m.getall(6) == range(6, 100, 7)
+
+
+def test_popone_queue():
+    m = MutableMultiMap()
+    for i in range(1000):
+        m.append(('job', i))
+        m.append((i % 3, i))
+    for i in range(500):
+        assert m.popone('job') == i
+    m.insert(0, ('job', 'first'))
+    m.setall('job', ['a', 'b'] + range(1001, 1010))
+    assert isinstance(m._key_ids['job'], list)
+    assert m.popone('job') == 'a'
+    m.setall('job', ['x'])
+    assert m.getall('job') == ['x'] and m.alllen() == 1001
+    assert m.getall(1) == range(1, 1000, 3)
+
+
+def test_popitem_ends():
+    m = MutableMultiMap([(i % 4, i) for i in range(1000)])
+    m.compact_threshold = 1
+    for i in range(300):
+        assert m.popitem(0) == (i % 4, i)
+        assert m.popitem() == ((999 - i) % 4, 999 - i)
+    assert m._head == 300 and m._dead == 300
+    del m[0]
+    m.append(('x', 'y'))
+    assert m.popitem(0) == (1, 301)
+    assert m.popitem(-1) == ('x', 'y')
+    assert m.getall(2) == range(302, 700, 4)
+    m.compact_threshold = 0.5
+    m.popone(3)
+    assert m._dead == 0 and m.popitem(0) == (2, 302)
+    
+    # From the middle, pairs are taken out without leaving tombstones.
+    m = MutableMultiMap([(i % 4, i) for i in range(100)])
+    m.index_values()
+    m.popone(1)
+    expected = m.allitems()
+    for i in range(20):
+        assert m.popitem(30) == expected.pop(30)
+        assert m._dead == 0 and m.allitems() == expected
+    assert dict((k, list(v)) for k, v in m._key_ids.iteritems()) == \
+        MutableMultiMap(expected)._key_ids
+    assert m._value_ids == dict((v, [i]) for i, (k, v) in enumerate(expected))
+
+
+def test_noop_changes():
+    # Changes which find nothing to do don't unshare a copy.
+    m = MutableMultiMap([('a', 1), ('b', 2), ('a', 3)])
+    c = m.copy()
+    c.discard('x')
+    assert c.popall('x') == [] and c.pop('x', None) is None
+    c.delete_many(['x', 'y'])
+    c.setall('x', [])
+    c.setall_many({'x': [], 'y': []})
+    try:
+        del c['x']
+    except KeyError:
+        pass
+    assert c._pairs is m._pairs and c._key_ids is m._key_ids
+    c.delete_many(['x', 'a', 'a'])
+    assert c._pairs is not m._pairs and c.allitems() == [('b', 2)]
+    assert m.allitems() == [('a', 1), ('b', 2), ('a', 3)]
+    
+    m = LinkedMutableMultiMap([('a', 1)])
+    version = m._version
+    m.discard('x')
+    m.delete_many(['x'])
+    m.setall('x', [])
+    assert m._version == version
+
+
+def test_serialization():
+    import pickle
+    pairs = [(i % 7, str(i)) for i in range(50)]
+    for cls in (MultiMap, MutableMultiMap, LinkedMutableMultiMap,
+        CompactMultiMap, FrozenMultiMap):
+        m = cls(pairs)
+        m.note = 'kept'
+        for copy in (pickle.loads(pickle.dumps(m, 2)), cls.from_bytes(m.to_bytes())):
+            assert type(copy) is cls
+            assert copy.allitems() == pairs
+            assert copy.getall(3) == m.getall(3)
+            assert copy._key_ids == m._key_ids
+        assert pickle.loads(pickle.dumps(m)).note == 'kept'
+    m = MutableMultiMap(pairs)
+    del m[3]
+    assert pickle.loads(pickle.dumps(m)).allitems() == m.allitems()
+    m = DelayedMutableMultiMap(lambda: iter(pairs))
+    assert pickle.loads(pickle.dumps(m)).allitems() == pairs
+    
+    # Unpickling doesn't go through __init__, which may need arguments.
+    for base in (MultiMap, MutableMultiMap, LinkedMutableMultiMap,
+        CompactMultiMap, FrozenMultiMap, DelayedMutableMultiMap,
+        SortedKeysMutableMultiMap, JournaledLinkedMutableMultiMap):
+        global Named
+        class Named(base):
+            def __init__(self, name, *args):
+                self.name = name
+                base.__init__(self, *args)
+        m = Named('n', lambda: iter(pairs)) if base is DelayedMutableMultiMap \
+            else Named('n', pairs)
+        for copy in (pickle.loads(pickle.dumps(m, 2)),
+            Named.from_bytes(m.to_bytes())):
+            assert type(copy) is Named and copy.allitems() == pairs
+            if isinstance(copy, MutableMultiMap):
+                copy.append((3, 'x'))
+                del copy[0]
+                assert copy.getall(3)[-1] == 'x' and 0 not in copy
+        assert pickle.loads(pickle.dumps(m)).name == 'n'
+    del Named
+
+
+def test_mapped():
+    import os, pickle, random, tempfile
+    rand = random.Random(1234)
+    pairs = [(rand.randrange(100), rand.random()) for i in range(1000)]
+    pairs.append((u'unicode', ('a', 1)))
+    fd, path = tempfile.mkstemp()
+    try:
+        MappedMultiMap.write(path, pairs)
+        m = MappedMultiMap(path)
+        expected = MultiMap(pairs)
+        assert m.allitems() == pairs
+        assert m.items() == expected.items()
+        assert m._key_ids == expected._key_ids
+        for key in range(-5, 105) + [u'unicode']:
+            assert m.getall(key) == expected.getall(key)
+            assert m.get(key) == expected.get(key)
+        copy = pickle.loads(pickle.dumps(m))
+        assert copy.allitems() == pairs
+        copy.close()
+        m.close()
+        MappedMultiMap.write(path, [])
+        m = MappedMultiMap(path)
+        assert not m and m.allitems() == [] and 'x' not in m
+        m.close()
+    finally:
+        os.close(fd)
+        os.unlink(path)
+
+
+def test_instrumentation():
+    import pickle
+    registry = Instrumentation()
+    pairs = [(i % 5, i) for i in range(20)]
+    
+    m = registry.instrument(CompactMultiMap)(pairs)
+    assert registry.instrument(m) is m and type(m).__name__ == 'CompactMultiMap'
+    assert m.getall(3) == [3, 8, 13, 18]
+    assert registry.stats['CompactMultiMap', '_set_pairs'].pairs == 20
+    copy = pickle.loads(pickle.dumps(m, 2))
+    assert type(copy) is CompactMultiMap and copy.allitems() == pairs
+    
+    m = registry.instrument(DelayedMultiMap(lambda: iter(pairs)))
+    assert m[1] == 1
+    assert registry.stats['DelayedMultiMap', '_pull'].pairs == 2
+    assert m.alllen() == 20
+    assert registry.stats['DelayedMultiMap', '_drain'].pairs == 18
+    
+    class Upper(MutableMultiMap):
+        def _conform_key(self, key):
+            return str(key).upper()
+    cls = registry.instrument(Upper)
+    assert registry.instrument(cls) is cls
+    m = cls([('a', 1), ('b', 2)])
+    m.append(('a', 3))
+    assert m.getall('A') == [1, 3]
+    assert registry.stats['Upper', '_conform_key'].calls == 4
+    assert ('MutableMultiMap', '_conform_key') not in registry.stats
+    
+    registry.reset()
+    assert registry.snapshot() == {}
+    assert type(uninstrument(m)) is Upper
+    m.append(('c', 4))
+    assert registry.snapshot() == {}
+
+
+def test_pairs_view():
+    import os, random, tempfile
+    rand = random.Random(1234)
+    pairs = [(rand.randrange(10), rand.randrange(5)) for i in range(100)]
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    MappedMultiMap.write(path, pairs)
+    maps = [cls(pairs) for cls in (MultiMap, MutableMultiMap,
+        LinkedMutableMultiMap, CompactMultiMap, FrozenMultiMap)]
+    maps.append(DelayedMutableMultiMap(lambda: iter(pairs)))
+    maps.append(MappedMultiMap(path))
+    try:
+        for m in maps:
+            view = m.pairs
+            assert len(view) == len(pairs) and list(view) == pairs
+            assert list(reversed(view)) == pairs[::-1]
+            for i in (0, 1, 50, -1, -100):
+                assert view[i] == pairs[i]
+            for index in (slice(10, 20), slice(None, None, -3), slice(-5, None)):
+                assert view[index].allitems() == pairs[index]
+            for pair in [(k, v) for k in range(11) for v in range(5)]:
+                expected = pairs.count(pair)
+                assert view.count(pair) == expected
+                assert (pair in view) == bool(expected)
+                if expected:
+                    assert view.index(pair) == pairs.index(pair)
+                if pair in pairs[40:60]:
+                    assert view.index(pair, 40, 60) == pairs.index(pair, 40, 60)
+            for key in range(11):
+                assert m.count(key) == len(m.getall(key))
+            try:
+                view[100]
+            except IndexError:
+                pass
+            else:
+                assert False
+    finally:
+        maps[-1].close()
+        os.unlink(path)
+    
+    # Removing keeps everything in step, through tombstones and compaction.
+    for cls in (MutableMultiMap, LinkedMutableMultiMap):
+        m = cls(pairs)
+        expected = list(pairs)
+        view = m.pairs
+        for i in range(90):
+            pair = rand.choice(expected)
+            expected.remove(pair)
+            view.remove(pair)
+            assert list(view) == expected
+            j = rand.randrange(len(expected))
+            assert view[j] == expected[j]
+            assert view.index(expected[j]) == expected.index(expected[j])
+        assert m.allitems() == MultiMap(expected).allitems()
+        assert m.keys() == MultiMap(expected).keys()
+    
+    # Reading by position neither compacts nor unshares a copy.
+    for index_values in (False, True):
+        m = MutableMultiMap(pairs)
+        m.compact_threshold = 1
+        expected = list(pairs)
+        for i in range(30):
+            pair = rand.choice(expected)
+            expected.remove(pair)
+            m.remove(pair)
+        if index_values:
+            m.index_values()
+        c = m.copy()
+        size = len(expected)
+        for view in (m.pairs, c.pairs):
+            for i in range(-size, size):
+                assert view[i] == expected[i]
+            for index in (slice(10, 20), slice(None, None, -3), slice(-5, None),
+                slice(20, 10), slice(0, size)):
+                assert view[index].allitems() == expected[index]
+            for pair in set(expected):
+                assert view.index(pair) == expected.index(pair)
+                assert view.count(pair) == expected.count(pair)
+                if pair in expected[10:40]:
+                    assert view.index(pair, 10, 40) == \
+                        expected.index(pair, 10, 40)
+            for i in (size, -size - 1):
+                try:
+                    view[i]
+                except IndexError:
+                    pass
+                else:
+                    assert False
+        for key in range(11):
+            assert m.count(key) == len([k for k, v in expected if k == key])
+        assert m._dead == 30 and c._pairs is m._pairs
+
+
+def _random_changes(m, rand, steps=2000, keys=10, values=None, copies=True):
+    """Make random changes to a MutableMultiMap, checking it against a list
+    of the pairs it should have after each of them.
+    
+    Yields (m, key, value) after every change, for the caller to check
+    whatever else it needs to with the key and value the change was made
+    with. If copies is set, m is sometimes replaced by a copy (or a pickled
+    copy) of itself. Values are the number of the step, or are drawn from
+    range(values) if it is given.
+    
+    """
+    import pickle
+    expected = m.allitems()
+    
+    def setall(key, new):
+        ids = [j for j, pair in enumerate(expected) if pair[0] == key]
+        for j, x in zip(ids, new):
+            expected[j] = (key, x)
+        for j in reversed(ids[len(new):]):
+            del expected[j]
+        expected.extend((key, x) for x in new[len(ids):])
+    
+    def getall(key):
+        return [v for k, v in expected if k == key]
+    
+    for i in xrange(steps):
+        draw = lambda: i if values is None else rand.randrange(values)
+        key = rand.randrange(keys)
+        value = draw()
+        op = rand.randrange(16)
+        if op == 0:
+            index = rand.randrange(-5, len(expected) + 5)
+            m.insert(index, (key, value))
+            expected.insert(index, (key, value))
+        elif op == 1:
+            m.discard(key)
+            setall(key, [])
+        elif op == 2:
+            found = getall(key)
+            assert m.popone(key, None) == (found[0] if found else None)
+            if found:
+                expected.remove((key, found[0]))
+        elif op == 3 and expected:
+            index = rand.choice([0, -1, rand.randrange(-len(expected),
+                len(expected))])
+            assert m.popitem(index) == expected.pop(index)
+        elif op == 4:
+            new = [draw() for j in range(rand.randrange(4))]
+            m.setall(key, iter(new))
+            setall(key, new)
+        elif op == 5:
+            batch = [(rand.randrange(-5, len(expected) + 5),
+                (rand.randrange(keys), draw())) for j in range(3)]
+            m.insert_many(batch)
+            # Every index is into the pairs as they were before.
+            size = len(expected)
+            batch = [(min(j, size) if j >= 0 else max(0, j + size), pair)
+                for j, pair in batch]
+            batch.sort(key=itemgetter(0))
+            for j, (index, pair) in enumerate(batch):
+                expected.insert(index + j, pair)
+        elif op == 6:
+            batch = dict((rand.randrange(keys), [draw() for k in
+                range(rand.randrange(3))]) for j in range(3))
+            m.setall_many(batch)
+            for k, new in batch.iteritems():
+                setall(k, new)
+            m.delete_many([key, key + 1])
+            setall(key, [])
+            setall(key + 1, [])
+        elif op == 7:
+            method, kwargs = rand.choice([
+                ('sort', {}),
+                ('sort', dict(key=itemgetter(1), reverse=True)),
+                ('sort_keys', {}),
+                ('sort_keys', dict(reverse=True)),
+                ('sort_keys', dict(key=lambda k: k // 3)),
+                ('sort_keys', dict(key=lambda k: k % 2, reverse=True)),
+                ('reverse', {}),
+            ])
+            getattr(m, method)(**kwargs)
+            if method == 'reverse':
+                expected.reverse()
+            elif method == 'sort':
+                expected.sort(**kwargs)
+            else:
+                sort_key = kwargs.get('key') or (lambda k: k)
+                expected.sort(key=lambda pair: sort_key(pair[0]),
+                    reverse=kwargs.get('reverse', False))
+        elif op == 8:
+            found = getall(key)
+            assert m.pop(key, None) == (found[0] if found else None)
+            m.extend([(key, value), (key + 1, value)])
+            assert m.popall(key) == [value]
+            setall(key, [])
+            expected.append((key + 1, value))
+        elif op == 9 and expected:
+            pair = rand.choice(expected)
+            m.remove(pair)
+            expected.remove(pair)
+        elif op == 10:
+            m.update({key: value})
+            setall(key, [value])
+            m.setdefault(key + 1, value)
+            if not getall(key + 1):
+                expected.append((key + 1, value))
+        elif op == 11:
+            edited = expected[::2] + [(key, value)]
+            m.apply_delta(m.diff(MultiMap(edited)))
+            expected[:] = edited
+        elif op == 12 and copies:
+            m = rand.choice((m.copy(), pickle.loads(pickle.dumps(m, 2))))
+        elif op == 13 and not rand.randrange(20):
+            m.clear()
+            del expected[:]
+        else:
+            m.append((key, value))
+            expected.append((key, value))
+        
+        assert m.allitems() == expected
+        assert m.getall(key) == getall(key)
+        assert m.keys() == sorted(set(k for k, v in expected),
+            key=[k for k, v in expected].index)
+        assert len(m) == len(m.keys()) and m.alllen() == len(expected)
+        if expected:
+            index = rand.randrange(-len(expected), len(expected))
+            assert m.pairs[index] == expected[index]
+        yield m, key, value
+
+
+def test_linked_matches_list():
+    import random
+    rand = random.Random(1234)
+    for cls in (MutableMultiMap, LinkedMutableMultiMap):
+        m = cls()
+        # Small blocks, so that they are split and merged all the time.
+        m.block_size = 4
+        for m, key, value in _random_changes(m, rand, copies=False):
+            if cls is LinkedMutableMultiMap:
+                for block in m._blocks:
+                    assert 0 < len(block.nodes) <= 2 * m.block_size
+                    assert all(node.block is block for node in block.nodes)
+        m._compact()
+        assert dict((k, list(v)) for k, v in m._key_ids.iteritems()) == \
+            MutableMultiMap(m.allitems())._key_ids
+
+
+def test_sorted_keys():
+    import random
+    rand = random.Random(4321)
+    m = SortedKeysMutableMultiMap()
+    for m, key, value in _random_changes(m, rand, keys=20):
+        keys = sorted(m.keys())
+        assert m.sortedkeys() == keys
+        lo, hi = sorted((rand.randrange(22), rand.randrange(22)))
+        assert list(m.irange(lo, hi)) == [k for k in keys if lo <= k <= hi]
+        assert list(m.irange(lo, hi, (False, False))) == [k for k in keys if lo < k < hi]
+        assert list(m.irangeallitems(lo)) == sorted(
+            [p for p in m.allitems() if p[0] >= lo], key=lambda p: p[0])
+    m = SortedKeysMultiMap.from_bytes(m.to_bytes())
+    assert m.sortedkeys() == sorted(m.keys())
+
+
+def test_grouped():
+    import random
+    rand = random.Random(1234)
+    pairs = [(rand.randrange(10), i) for i in range(100)]
+    expected = MultiMap(pairs)
+    expected = [(key, expected.getall(key)) for key in expected]
+    for cls in (MultiMap, MutableMultiMap, LinkedMutableMultiMap,
+        CompactMultiMap, FrozenMultiMap, DelayedMultiMap):
+        m = cls(lambda: iter(pairs)) if cls is DelayedMultiMap else cls(pairs)
+        assert m.itemlists() == expected
+        assert list(m.iterlists()) == [x[1] for x in expected]
+        g = m.grouped()
+        assert g.items() == [(k, tuple(v)) for k, v in expected]
+        assert m.grouped() is g
+    
+    # Every change invalidates the cached view.
+    for cls in (MutableMultiMap, LinkedMutableMultiMap):
+        m = cls(pairs)
+        for change in [
+            lambda: m.append((1, 'x')),
+            lambda: m.insert(5, (2, 'y')),
+            lambda: m.popone(1),
+            lambda: m.popitem(0),
+            lambda: m.setall(3, ['z']),
+            lambda: m.remove((3, 'z')),
+            lambda: m.reverse(),
+            lambda: m.sort_keys(),
+            lambda: m.delete_many([4, 5]),
+            lambda: m.insert_many([(0, (6, 'w'))]),
+            lambda: m.clear(),
+        ]:
+            g = m.grouped()
+            change()
+            assert m.grouped() is not g
+            assert m.grouped().items() == [(k, tuple(v)) for k, v in m.itemlists()]
+        
+        # ... but changing a copy does not.
+        m.append((1, 'x'))
+        g = m.grouped()
+        m.copy().append((7, 'v'))
+        assert m.grouped() is g
+        
+        # ... and nor do changes which find nothing to do.
+        m.discard('x')
+        m.delete_many(['x'])
+        m.setall('x', [])
+        m.popone('x', None)
+        assert m.grouped() is g
+
+
+def test_diff():
+    import random
+    rand = random.Random(1234)
+    for i in range(300):
+        pairs = [(rand.randrange(5), rand.randrange(5))
+            for j in range(rand.randrange(30))]
+        edited = list(pairs)
+        for j in range(rand.randrange(5)):
+            index = rand.randrange(len(edited) + 1)
+            if rand.randrange(2) and index < len(edited):
+                del edited[index:index + rand.randrange(1, 4)]
+            else:
+                edited[index:index] = [(rand.randrange(5), rand.randrange(5))
+                    for k in range(rand.randrange(1, 4))]
+        b = MultiMap(edited)
+        for cls in (MutableMultiMap, LinkedMutableMultiMap,
+            SortedKeysMutableMultiMap):
+            a = cls(pairs)
+            # Tombstones must not throw the positions off.
+            a.append(('x', 'y'))
+            a.popone('x')
+            expected = (a == b)
+            assert expected == (pairs == edited)
+            assert (a != b) == (not expected)
+            delta = a.diff(b)
+            assert bool(delta) == (not expected)
+            a.apply_delta(delta)
+            assert a == b and a.allitems() == edited
+            assert a.keys() == b.keys()
+            for key in range(5):
+                assert a.getall(key) == b.getall(key)
+            if cls is not LinkedMutableMultiMap:
+                assert dict((k, list(v)) for k, v in a._key_ids.iteritems()) \
+                    == b._key_ids
+    
+    # Unhashable values are replaced wholesale, between the common ends.
+    a = MutableMultiMap([('a', [1]), ('b', [2]), ('c', [3])])
+    b = MutableMultiMap([('a', [1]), ('b', [4]), ('c', [3])])
+    assert a.diff(b) == [('replace', 1, 1, [('b', [4])])]
+    a.apply_delta(a.diff(b))
+    assert a == b
+    
+    # Equality is told apart by the counts, and agrees across classes.
+    a = MultiMap([('a', 1), ('a', 2), ('b', 3)])
+    assert a != MultiMap([('a', 1), ('b', 2), ('b', 3)])
+    assert a == CompactMultiMap(a.allitems()) == FrozenMultiMap(a.allitems())
+    assert a == LinkedMutableMultiMap(a.allitems())
+    assert a == ConcurrentMultiMap(a.allitems())
+    assert ConcurrentMultiMap(a.allitems()) == a
+    assert a != ConcurrentMultiMap(reversed(a.allitems()))
+    assert a == {'a': 1, 'b': 3}
+    assert a != {'a': 2, 'b': 3}
+    assert a != [('a', 1)]
+    
+    c = ConcurrentMultiMap(a.allitems())
+    assert c.diff(c) == []
+
+
+def test_journal():
+    import random
+    rand = random.Random(1234)
+    for cls in (JournaledMutableMultiMap, JournaledLinkedMutableMultiMap):
+        m = cls([(1, 'a'), (2, 'b')])
+        replica = MutableMultiMap(m.allitems())
+        seen = m.journal_version
+        for m, key, value in _random_changes(m, rand, 1000, copies=False):
+            if rand.randrange(5) == 0:
+                for version, name, args, kwargs in m.changes_since(seen):
+                    getattr(replica, name)(*args, **kwargs)
+                    seen = version
+                assert seen == m.journal_version
+                assert replica == m
+    
+    m = JournaledMutableMultiMap([('a', 1), ('b', 2)])
+    m.journal_size = 3
+    m.pop('a')
+    m.popone('x', None)
+    m.discard('x')
+    try:
+        del m['x']
+    except KeyError:
+        pass
+    m.delete_many(['x'])
+    m.setall('x', [])
+    m.setall_many({'x': [], 'y': ()})
+    m.popall('x')
+    assert m.journal_version == 1
+    assert list(m.changes_since(0)) == [(1, '__delitem__', ('a', ), {})]
+    assert list(m.changes_since(1)) == []
+    for i in range(3):
+        m.append(('c', i))
+    assert [c[0] for c in m.changes_since(1)] == [2, 3, 4]
+    try:
+        m.changes_since(0)
+    except JournalOverflow:
+        pass
+    else:
+        assert False
+    try:
+        m.changes_since(5)
+    except ValueError:
+        pass
+    else:
+        assert False
+    
+    # The size may be changed after the journal has started.
+    m.journal_size = 5
+    for i in range(3):
+        m.append(('d', i))
+    assert [c[0] for c in m.changes_since(2)] == [3, 4, 5, 6, 7]
+    m.journal_size = 2
+    m.popone('d')
+    assert [c[0] for c in m.changes_since(6)] == [7, 8]
+    m.popone('d')
+    m.popone('d')
+    
+    # A copy has its own journal, and a thawed copy has none.
+    c = m.copy()
+    c.append(('d', 1))
+    assert m.journal_version == 10 and c.journal_version == 11
+    assert list(c.changes_since(10)) == [(11, 'append', (('d', 1), ), {})]
+    assert [x[0] for x in m.changes_since(8)] == [9, 10]
+    assert type(m.freeze().thaw()) is MutableMultiMap
+    
+    m = JournaledLinkedMutableMultiMap([('a', 1)])
+    m.discard('x')
+    m.delete_many(['x', 'y'])
+    m.setall('x', [])
+    assert m.journal_version == 0 and list(m.changes_since(0)) == []
+
+
+def test_value_index():
+    import random
+    rand = random.Random(1234)
+    for cls in (MutableMultiMap, LinkedMutableMultiMap,
+        SortedKeysMutableMultiMap):
+        m = cls((rand.randrange(10), rand.randrange(10)) for i in range(20))
+        m.index_values()
+        copies = []
+        for m, key, value in _random_changes(m, rand, values=10,
+            copies=False):
+            if not rand.randrange(10):
+                copies.append((m.copy(), m.allitems()))
+            if not rand.randrange(10):
+                # An unhashable value turns the index off until it is gone.
+                m.append((key, [value]))
+                assert key in m.keysfor([value])
+                m.remove((key, [value]))
+            
+            pairs = m.allitems()
+            expected = [k for k, v in pairs if v == value]
+            assert m.keysfor(value) == sorted(set(expected), key=expected.index)
+            assert m.containsvalue(value) == bool(expected)
+            if (key, value) in pairs:
+                assert m.index((key, value)) == pairs.index((key, value))
+            else:
+                try:
+                    m.index((key, value))
+                except ValueError:
+                    pass
+                else:
+                    assert False
+            if cls is LinkedMutableMultiMap:
+                if m._value_nodes is not None:
+                    assert m._value_nodes == m._build_value_nodes()
+            else:
+                # Compacting a shared map takes a copy, and drops the index.
+                m._compact()
+                if m._value_ids is not None:
+                    assert m._value_ids == \
+                        MutableMultiMap(pairs)._build_value_ids()
+        
+        for copy, pairs in copies:
+            assert copy.allitems() == pairs
+            for value in range(10):
+                expected = [k for k, v in pairs if v == value]
+                assert copy.keysfor(value) == sorted(set(expected),
+                    key=expected.index)
+    
+    m = MutableMultiMap([('a', [1])])
+    try:
+        m.index_values()
+    except TypeError:
+        pass
+    else:
+        assert False
+    assert not m._values_indexed
+    assert m.keysfor([1]) == ['a']
+    
+    # The linked map keeps its index of nodes through changes to single pairs.
+    m = LinkedMutableMultiMap([(i % 3, i % 5) for i in range(20)])
+    m.index_values()
+    index = m._value_nodes
+    m.insert(4, ('x', 1))
+    m.setall(0, [9, 1])
+    m.popitem(7)
+    m.remove((2, 2))
+    assert m._value_nodes is index and index == m._build_value_nodes()
+    assert m.index(('x', 1)) == 3 and m.keysfor(1) == [1, 0, 'x', 2]
+    
+    # While there is an unhashable value, the index is not built again until
+    # the next change.
+    for cls in (MutableMultiMap, LinkedMutableMultiMap):
+        built = []
+        class Counted(cls):
+            def _build_value_ids(self):
+                built.append(1)
+                return cls._build_value_ids(self)
+            def _build_value_nodes(self):
+                built.append(1)
+                return cls._build_value_nodes(self)
+        m = Counted([('a', 1), ('b', 2)])
+        m.index_values()
+        m.append(('c', [3]))
+        del built[:]
+        for i in range(5):
+            assert m.keysfor([3]) == ['c'] and m.containsvalue(2)
+        assert len(built) == 1
+        m.remove(('c', [3]))
+        assert m.keysfor(2) == ['b'] and len(built) == 2
+        assert m.keysfor(1) == ['a'] and len(built) == 2
+
+
+def test_concurrent():
+    import pickle, threading, time
+    m = ConcurrentMultiMap((key, 0) for key in range(10))
+    errors = []
+    stop = []
+    
+    def write():
+        n = 0
+        while not stop:
+            n += 1
+            # Every key always has as many copies of one value as the value.
+            m.setall(n % 10, [n] * n if n < 50 else [n])
+            with m.transaction() as writable:
+                writable.popone(n % 10, None)
+                writable.append((n % 10, n))
+    
+    def read():
+        n = 0
+        while not stop:
+            n += 1
+            itemlists = m.snapshot().itemlists() if n % 10 else m.itemlists()
+            for key, values in itemlists:
+                if len(set(values)) != 1:
+                    errors.append(values)
+            if len(m.allitems()) < 10 or len(m) != 10:
+                errors.append(m.allitems())
+    
+    threads = [threading.Thread(target=write) for i in range(2)]
+    threads.extend(threading.Thread(target=read) for i in range(4))
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    stop.append(True)
+    for thread in threads:
+        thread.join()
+    assert not errors, errors[:5]
+    
+    copy = m.copy()
+    copy.clear()
+    assert m.alllen() >= 10 and not copy
+    assert pickle.loads(pickle.dumps(m)) == m
+    
+    # Writers given this map, or one which is given this one, don't deadlock.
+    a = ConcurrentMultiMap([('a', 1), ('b', 2)])
+    b = ConcurrentMultiMap([('b', 3), ('c', 4)])
+    a.update(a)
+    a.extend((k, v) for k, v in a.iterallitems())
+    a.setall_many(a.grouped())
+    assert a.allitems() == [('a', 1), ('b', 2)] * 2
+    threads = [threading.Thread(target=lambda: [a.update(b) for i in range(200)]),
+        threading.Thread(target=lambda: [b.update(a) for i in range(200)])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(a.keys()) == sorted(b.keys()) == ['a', 'b', 'c']
+    
+    # Readers don't take the lock unless a write is being made.
+    with a._lock:
+        assert a.getall('c') == b.getall('c') and len(a) == 3
+    
+    # Copies and snapshots conform keys as the map does.
+    class CaseInsensitive(ConcurrentMultiMap):
+        class _map_class(MutableMultiMap):
+            def _conform_key(self, key):
+                return key.lower()
+    c = CaseInsensitive([('A', 1)])
+    assert c['a'] == c.snapshot()['A'] == c.copy()['A'] == 1
+    assert isinstance(c.copy()._map, CaseInsensitive._map_class)
+
+
+def test_compact_matches_multimap():
+    import random
+    rand = random.Random(1234)
+    pairs = [(rand.randrange(50), i) for i in range(500)]
+    a = MultiMap(pairs)
+    b = CompactMultiMap(pairs)
+    assert a.allitems() == b.allitems()
+    assert a.items() == b.items()
+    assert a._key_ids == b._key_ids
+    for key in range(55):
+        assert a.getall(key) == b.getall(key)
+        assert a.get(key) == b.get(key)
+    assert b.grouped() is b.grouped()
+    assert dict(b.grouped()) == dict(a.grouped())
+    assert vars(b) == {}
+
+
+def test_freeze_and_thaw():
+    m = MutableMultiMap([(i % 5, i) for i in range(20)])
+    del m[3]
+    original = m.allitems()
+    f = m.freeze()
+    g = f.thaw()
+    h = g.freeze()
+    assert not m._dead and f._pairs is g._pairs is h._pairs
+    m.setall(1, ['x'])
+    g.append((3, 'y'))
+    g.popone(0)
+    assert m.getall(1) == ['x']
+    assert f.allitems() == h.allitems() == original
+    assert f.getall(1) == h.getall(1) == range(1, 20, 5)
+    assert g.getall(3) == ['y'] and g.getall(0) == range(5, 20, 5)
+    assert f.getall(0) == range(0, 20, 5)
+    assert f == h and hash(f) == hash(h) and g.freeze() != f
+    
+    # Subclasses which conform keys freeze and thaw to ones which do too.
+    class CaseInsensitive(MutableMultiMap):
+        def _conform_key(self, key):
+            return key.lower()
+    m = CaseInsensitive([('A', 1), ('b', 2)])
+    f = m.freeze()
+    assert isinstance(f, FrozenMultiMap) and 'a' in f and f['B'] == 2
+    assert type(f) is type(instrument(m, Instrumentation()).freeze())
+    g = f.thaw()
+    assert type(g) is CaseInsensitive
+    g['a'] = 3
+    assert g.allitems() == [('a', 3), ('b', 2)]
+    class FrozenCaseInsensitive(FrozenMultiMap):
+        def _conform_key(self, key):
+            return key.lower()
+    g = FrozenCaseInsensitive([('A', 1)]).thaw()
+    assert isinstance(g, MutableMultiMap) and g.getall('a') == [1]
+    assert type(g.freeze()) is FrozenCaseInsensitive
+    assert type(MutableMultiMap().freeze()) is FrozenMultiMap
+    
+    # Conformers may use helpers, and class and instance attributes.
+    class Prefixed(MutableMultiMap):
+        separator = ':'
+        def __init__(self, prefix, *args, **kwargs):
+            self.prefix = prefix
+            MutableMultiMap.__init__(self, *args, **kwargs)
+        def _normalize(self, key):
+            return key.strip().lower()
+        def _conform_key(self, key):
+            return self.prefix + self.separator + self._normalize(key)
+        def shout(self):
+            self['x'] = 'X'
+    m = Prefixed('p', [(' A', 1)])
+    f = m.freeze()
+    assert f.allitems() == [('p:a', 1)] and f['A '] == 1 and f.prefix == 'p'
+    assert not hasattr(f, 'append')
+    g = f.thaw()
+    assert type(g) is Prefixed and g.prefix == 'p' and g['a'] == 1
+    g.shout()
+    assert g.getall('X') == ['X'] and f.alllen() == 1
+    
+    class Normalized(ConcurrentMultiMap):
+        class _map_class(MutableMultiMap):
+            def _normalize(self, key):
+                return key.lower()
+            def _conform_key(self, key):
+                return self._normalize(key)
+    c = Normalized([('A', 1)])
+    assert c.snapshot()['a'] == c.snapshot().thaw()['A'] == 1
 
 
 if __name__ == '__main__':